@@ -0,0 +1,132 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import argparse
+import itertools
+import time
+
+import torch
+
+import loralib as lora
+
+
+parser = argparse.ArgumentParser(description='Benchmark the forward pass of loralib layers')
+
+parser.add_argument('--layer', default='linear', choices=['linear', 'embedding', 'conv'], help='layer to benchmark')
+
+parser.add_argument('--batch', type=int, nargs='+', default=[1, 8], help='batch sizes')
+
+parser.add_argument('--seq_len', type=int, nargs='+', default=[1, 128, 512], help='sequence lengths')
+
+parser.add_argument('--hidden', type=int, nargs='+', default=[768, 1024, 1280], help='hidden sizes')
+
+parser.add_argument('--vocab', type=int, nargs='+', default=[50257, 250000], help='vocabulary sizes')
+
+parser.add_argument('--image_size', type=int, nargs='+', default=[32, 64], help='image sizes')
+
+parser.add_argument('--kernel_size', type=int, default=3, help='convolution kernel size')
+
+parser.add_argument('--lora_dim', type=int, default=8, help='lora rank')
+
+parser.add_argument('--repeat', type=int, default=50, help='timed iterations per configuration')
+
+parser.add_argument('--backward', action='store_true', help='also time the backward pass')
+
+parser.add_argument('--device', default='cpu', help='device to run on')
+
+
+def timeit(fn, repeat, device):
+    # Warm up once, then report the mean wall time in milliseconds
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def step(layer, x, backward):
+    if backward:
+        layer(x).sum().backward()
+    else:
+        with torch.no_grad():
+            layer(x)
+
+
+def bench_linear(args, device):
+    print(f'{"batch":>6} {"seq":>6} {"hidden":>7} | {"merged":>9} {"unfused":>9} {"fused":>9} (ms)')
+    for batch, seq_len, hidden in itertools.product(args.batch, args.seq_len, args.hidden):
+        layer = lora.Linear(hidden, hidden, r=args.lora_dim, lora_alpha=2 * args.lora_dim).to(device)
+        torch.nn.init.normal_(layer.lora_B)
+        x = torch.randn(batch, seq_len, hidden, device=device, requires_grad=args.backward)
+
+        layer.eval()
+        merged = timeit(lambda: step(layer, x, args.backward), args.repeat, device)
+        # Unmerge; lora_dropout is 0 so train mode does not change the computation
+        layer.train()
+        layer.fused = False
+        unfused = timeit(lambda: step(layer, x, args.backward), args.repeat, device)
+        layer.fused = True
+        fused = timeit(lambda: step(layer, x, args.backward), args.repeat, device)
+        print(f'{batch:>6} {seq_len:>6} {hidden:>7} | {merged:9.3f} {unfused:9.3f} {fused:9.3f}')
+
+
+def bench_embedding(args, device):
+    # Time of a training step, including the optimizer, with dense and sparse gradients for lora_A
+    print(f'{"vocab":>7} {"batch":>6} {"seq":>6} {"hidden":>7} | {"dense":>9} {"sparse":>9} (ms)')
+    for vocab, batch, seq_len, hidden in itertools.product(args.vocab, args.batch, args.seq_len, args.hidden):
+        x = torch.randint(0, vocab, (batch, seq_len), device=device)
+        timings = []
+        for sparse in [False, True]:
+            layer = lora.Embedding(vocab, hidden, r=args.lora_dim, sparse=sparse).to(device)
+            if sparse:
+                optimizers = [
+                    torch.optim.SparseAdam([layer.lora_A]), 
+                    torch.optim.Adam([layer.lora_B])
+                ]
+            else:
+                optimizers = [torch.optim.Adam([layer.lora_A, layer.lora_B])]
+
+            def train_step():
+                layer(x).sum().backward()
+                for opt in optimizers:
+                    opt.step()
+                    opt.zero_grad()
+
+            timings.append(timeit(train_step, args.repeat, device))
+        print(f'{vocab:>7} {batch:>6} {seq_len:>6} {hidden:>7} | {timings[0]:9.3f} {timings[1]:9.3f}')
+
+
+def bench_conv(args, device):
+    # Unmerged Conv2d that rebuilds the kernel on every step against the two-convolution low-rank path
+    print(f'{"batch":>6} {"image":>6} {"channels":>8} | {"merged":>9} {"kernel":>9} {"low-rank":>9} (ms)')
+    for batch, image_size, channels in itertools.product(args.batch, args.image_size, args.hidden):
+        x = torch.randn(batch, channels, image_size, image_size, device=device, requires_grad=args.backward)
+        timings = []
+        for low_rank in [False, True]:
+            layer = lora.Conv2d(
+                channels, channels, args.kernel_size, r=args.lora_dim, lora_alpha=2 * args.lora_dim,
+                padding=args.kernel_size // 2, low_rank=low_rank
+            ).to(device)
+            if not low_rank:
+                layer.eval()
+                timings.append(timeit(lambda: step(layer, x, args.backward), args.repeat, device))
+            layer.train()
+            timings.append(timeit(lambda: step(layer, x, args.backward), args.repeat, device))
+        print(f'{batch:>6} {image_size:>6} {channels:>8} | {timings[0]:9.3f} {timings[1]:9.3f} {timings[2]:9.3f}')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    if args.layer == 'linear':
+        bench_linear(args, device)
+    elif args.layer == 'embedding':
+        bench_embedding(args, device)
+    elif args.layer == 'conv':
+        bench_conv(args, device)
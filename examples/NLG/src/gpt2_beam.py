@@ -32,7 +32,8 @@ from gpu import (
 from exp_utils import create_exp_dir
 
 from data_utils import FT_Dataset 
-from model import GPT2Config, GPT2LMModel
+from model import GPT2Config, GPT2LMModel, load_checkpoint
+from kv_cache import KVCache
 
 
 parser = argparse.ArgumentParser(description='PyTorch GPT2 beam decoding')
@@ -63,6 +64,18 @@ parser.add_argument('--lora_dim', type=int, default=0, help='lora attn dimension
 
 parser.add_argument('--lora_alpha', type=int, default=128, help='lora attn alpha')
 
+parser.add_argument('--fused_attn', action='store_true', help='use the fused attention kernel')
+
+parser.add_argument('--static_kv_cache', action='store_true', 
+                    help='decode with a preallocated KV cache updated in place')
+
+parser.add_argument('--paged_kv_cache', action='store_true', 
+                    help='decode with a block KV cache shared between beams and identical prompt prefixes')
+
+parser.add_argument('--kv_block_size', type=int, default=16, help='positions per block of the paged KV cache')
+
+parser.add_argument('--kv_cache_blocks', type=int, default=4096, help='number of blocks of the paged KV cache')
+
 parser.add_argument('--work_dir', type=str, default=os.getenv('PT_OUTPUT_DIR', 'gpt2_model'), 
                     help='working folder')
 
@@ -74,6 +87,17 @@ parser.add_argument('--no_repeat_ngram_size', type=int, default=4, help='no_repe
 
 parser.add_argument('--repetition_penalty', type=float, default=1.0, help='repetition_penalty')
 
+parser.add_argument('--decode', default='beam', choices=['beam', 'greedy', 'sample'], 
+                    help='beam search, or greedy decoding and sampling without beam bookkeeping')
+
+parser.add_argument('--temperature', type=float, default=1.0, help='sampling temperature')
+
+parser.add_argument('--top_k', type=int, default=0, help='sample from the top_k most likely tokens, 0 for all')
+
+parser.add_argument('--top_p', type=float, default=1.0, help='nucleus sampling probability mass')
+
+parser.add_argument('--forced_eos', action='store_true', help='force eos as the last token of eval_len tokens')
+
 parser.add_argument('--eos_token_id', action='append', type=int, default=[50256], 
                     help='eos token id')
 
@@ -90,117 +114,202 @@ def print_args(args):
 
 
 def _reorder_cache(past: Tuple, beam_idx: Tensor) -> Tuple[Tensor]:
+    if isinstance(past, KVCache):
+        return past.reorder_(beam_idx)
     return tuple(layer_past.index_select(1, beam_idx).contiguous().detach() for layer_past in past)
 
 
-def _calc_banned_ngram_tokens(
-    prev_input_ids: Tensor, 
-    num_hypos: int, 
-    no_repeat_ngram_size: int, 
-    cur_len: int
-) -> None:
-    """Copied from fairseq for no_repeat_ngram in beam_search"""
-    if cur_len + 1 < no_repeat_ngram_size:
-        # return no banned tokens if we haven't generated no_repeat_ngram_size tokens yet
-        return [[] for _ in range(num_hypos)]
-    
-    generated_ngrams = [{} for _ in range(num_hypos)]
-    for idx in range(num_hypos):
-        gen_tokens = prev_input_ids[idx].tolist()
-        generated_ngram = generated_ngrams[idx]
-        for ngram in zip(*[gen_tokens[i:] for i in range(no_repeat_ngram_size)]):
-            prev_ngram_tuple = tuple(ngram[:-1])
-            generated_ngram[prev_ngram_tuple] = generated_ngram.get(prev_ngram_tuple, []) + [ngram[-1]]
-
-    def _get_generated_ngrams(hypo_idx):
-        # Before decoding the next token, prevent decoding of ngrams that have already appeared
-        start_idx = cur_len + 1 - no_repeat_ngram_size
-        ngram_idx = tuple(prev_input_ids[hypo_idx, start_idx:cur_len].tolist())
-        return generated_ngrams[hypo_idx].get(ngram_idx, [])
-
-    banned_tokens = [_get_generated_ngrams(hypo_idx) for hypo_idx in range(num_hypos)]
-    return banned_tokens
-
-
-def _enforce_repetition_penalty_(
-    lprobs, 
-    batch_size, 
-    num_beams, 
-    prev_output_tokens, 
-    repetition_penalty
-):
-    """repetition penalty (from CTRL paper https://arxiv.org/abs/1909.05858). """
+class LogitsProcessor(object):
+    # Transforms the next token scores of all the rows of a batch, (rows, vocab), in place when possible.
+    # history : (rows, cur_len) tokens generated so far, None before the first token
+    def __call__(self, scores: Tensor, history: Optional[Tensor], cur_len: int) -> Tensor:
+        raise NotImplementedError
 
-    for i in range(batch_size * num_beams):
-        print('prev_output_tokens.shape', prev_output_tokens.shape)
-        print('prev_output_tokens[i].shape', prev_output_tokens[i].shape)
-
-        for previous_token in set(prev_output_tokens[i].tolist()):
-            # if score < 0 then repetition penalty has to multiplied to reduce the previous token probability
-            if lprobs[i, previous_token] < 0:
-                lprobs[i, previous_token] *= repetition_penalty
-            else:
-                lprobs[i, previous_token] /= repetition_penalty
-
-def _postprocess_next_token_scores(
-    scores,
-    history,
-    cur_len,
-    batch_size,
-    num_beams,
-    repetition_penalty=1.0,                                
-    no_repeat_ngram_size=4,
-    bad_words_ids=None,
-    min_length=0,
-    max_length=100,
-    eos_token_id=None,
-):
-    # repetition penalty (from CTRL paper https://arxiv.org/abs/1909.05858)
-    if repetition_penalty != 1.0 and history is not None:
-        _enforce_repetition_penalty_(scores, batch_size, num_beams, history, repetition_penalty)
-
-    # score: batch_size * beam, vocab
-    # set eos token prob to zero if min_length is not reached
-    if eos_token_id is not None and cur_len < min_length:
-        for eos in eos_token_id:
-            scores[:, eos] = -float("inf")
-
-    if no_repeat_ngram_size > 0 and history is not None:
-        # calculate a list of banned tokens to prevent repetitively generating the same ngrams
-        num_batch_hypotheses = batch_size * num_beams
-        # from fairseq: https://github.com/pytorch/fairseq/blob/a07cb6f40480928c9e0548b737aadd36ee66ac76/fairseq/sequence_generator.py#L345
-        banned_batch_tokens = _calc_banned_ngram_tokens(
-                history, num_batch_hypotheses, no_repeat_ngram_size, cur_len
+
+class LogitsProcessorList(list):
+    def __call__(self, scores: Tensor, history: Optional[Tensor], cur_len: int) -> Tensor:
+        for processor in self:
+            scores = processor(scores, history, cur_len)
+        return scores
+
+
+class RepetitionPenaltyProcessor(LogitsProcessor):
+    def __init__(self, repetition_penalty):
+        self.repetition_penalty = repetition_penalty
+
+    def __call__(self, scores, history, cur_len):
+        if history is not None:
+            _enforce_repetition_penalty_(scores, history, self.repetition_penalty)
+        return scores
+
+
+class MinLengthProcessor(LogitsProcessor):
+    # Set eos token prob to zero if min_length is not reached
+    def __init__(self, min_length, eos_token_id):
+        self.min_length = min_length
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, scores, history, cur_len):
+        if cur_len < self.min_length:
+            scores[:, self.eos_token_id] = -float("inf")
+        return scores
+
+
+class ForcedEOSProcessor(LogitsProcessor):
+    # Make the first eos token the only choice for the last position
+    def __init__(self, max_length, eos_token_id):
+        self.max_length = max_length
+        self.eos_token_id = eos_token_id[0]
+
+    def __call__(self, scores, history, cur_len):
+        if cur_len == self.max_length - 1:
+            scores.fill_(-float("inf"))
+            scores[:, self.eos_token_id] = 0
+        return scores
+
+
+class TemperatureProcessor(LogitsProcessor):
+    def __init__(self, temperature):
+        self.temperature = temperature
+
+    def __call__(self, scores, history, cur_len):
+        return scores.div_(self.temperature)
+
+
+class TopKProcessor(LogitsProcessor):
+    def __init__(self, top_k):
+        self.top_k = top_k
+
+    def __call__(self, scores, history, cur_len):
+        top_k = min(self.top_k, scores.shape[-1])
+        threshold = torch.topk(scores, top_k, dim=-1).values[:, -1:]
+        return scores.masked_fill_(scores < threshold, -float("inf"))
+
+
+class TopPProcessor(LogitsProcessor):
+    # Keep the most likely tokens until their probabilities add up to top_p, at least one per row
+    def __init__(self, top_p):
+        self.top_p = top_p
+
+    def __call__(self, scores, history, cur_len):
+        sorted_scores, sorted_idx = scores.sort(dim=-1, descending=True)
+        probs = F.softmax(sorted_scores.float(), dim=-1)
+        sorted_remove = probs.cumsum(dim=-1) - probs > self.top_p
+        remove = sorted_remove.scatter(1, sorted_idx, sorted_remove)
+        return scores.masked_fill_(remove, -float("inf"))
+
+
+class NgramBlocker(LogitsProcessor):
+    # Bans the tokens that would repeat an n-gram of the history of every hypothesis. The n-grams are
+    # kept in a preallocated (rows, max n-grams, n) tensor, reordered with the beams and extended with
+    # the newest n-gram at every step, and are compared with the last n - 1 tokens all at once.
+    def __init__(self, no_repeat_ngram_size, rows, max_len, device=None):
+        self.n = no_repeat_ngram_size
+        self.ngrams = torch.zeros(
+            (rows, max(max_len - self.n + 1, 0), self.n), dtype=torch.long, device=device
         )
+        self.count = 0
+
+    def update(self, beam_idx: Optional[Tensor], history: Tensor) -> None:
+        # history : (rows, cur_len), after reordering by beam_idx and appending the new tokens.
+        # beam_idx is None when the rows are not reordered.
+        if self.count > 0 and beam_idx is not None:
+            self.ngrams[:, :self.count] = self.ngrams[beam_idx, :self.count]
+        if history.shape[1] >= self.n:
+            self.ngrams[:, self.count] = history[:, -self.n:]
+            self.count += 1
+
+    def reorder_(self, rows: Tensor) -> None:
+        # Keep the given rows only, e.g. to drop finished samples
+        self.ngrams = self.ngrams[rows]
+
+    def ban_(self, scores: Tensor) -> Tensor:
+        if self.count == 0:
+            return scores
+        ngrams = self.ngrams[:, :self.count]
+        # The last n - 1 tokens of the history end the newest n-gram
+        prefix = ngrams[:, -1, 1:]
+        match = (ngrams[:, :, :-1] == prefix.unsqueeze(1)).all(dim=-1)
+        banned = scores.new_zeros(scores.shape).scatter_add_(1, ngrams[:, :, -1], match.to(scores.dtype))
+        return scores.masked_fill_(banned > 0, -float("inf"))
+
+    def __call__(self, scores, history, cur_len):
+        # prevent repetitively generating the same ngrams
+        return self.ban_(scores)
+
+
+def _enforce_repetition_penalty_(lprobs, prev_output_tokens, repetition_penalty):
+    """repetition penalty (from CTRL paper https://arxiv.org/abs/1909.05858). """
+    # Tokens repeated in the history gather and scatter the same value, so they are penalized once
+    score = lprobs.gather(1, prev_output_tokens)
+    # if score < 0 then repetition penalty has to multiplied to reduce the previous token probability
+    score = torch.where(score < 0, score * repetition_penalty, score / repetition_penalty)
+    lprobs.scatter_(1, prev_output_tokens, score)
 
-        for i, banned_tokens in enumerate(banned_batch_tokens):
-            scores[i, banned_tokens] = -float("inf")
 
-    return scores
+def logits_processors(args, ngram_blocker=None, sampling=False):
+    # The processors of the next token scores selected by args; the sampling ones only apply
+    # when sampling=True
+    processors = LogitsProcessorList()
+    # repetition penalty (from CTRL paper https://arxiv.org/abs/1909.05858)
+    if args.repetition_penalty != 1.0:
+        processors.append(RepetitionPenaltyProcessor(args.repetition_penalty))
+    if args.min_length > 0:
+        processors.append(MinLengthProcessor(args.min_length, args.eos_token_id))
+    if ngram_blocker is not None:
+        processors.append(ngram_blocker)
+    if sampling:
+        if args.temperature != 1.0:
+            processors.append(TemperatureProcessor(args.temperature))
+        if args.top_k > 0:
+            processors.append(TopKProcessor(args.top_k))
+        if args.top_p < 1.0:
+            processors.append(TopPProcessor(args.top_p))
+    if args.forced_eos:
+        processors.append(ForcedEOSProcessor(args.eval_len, args.eos_token_id))
+    return processors
 
 
 def _add_beam_candidate(
     best_score, 
     best_sequence, 
-    batch_size, 
-    num_beams, 
+    has_best, 
     beam_scores, 
     history, 
+    length_penalty=1.0, 
     eos_token_id=None
 ):
-    last_tokens = history[:, -1]
-    for _i in range(batch_size * num_beams):
-        if eos_token_id is None or last_tokens[_i] in eos_token_id:
-            cur_len = history.shape[-1]
-            _score = beam_scores.view(-1)[_i] / cur_len ** args.length_penalty
-
-            batch_id = _i // num_beams
-
-            if not batch_id in best_score or best_score[batch_id] < _score:
-                best_score[batch_id] = _score
-                best_sequence[batch_id][:cur_len] = history[_i]
-
-            beam_scores.view(-1)[_i] = -float("inf")
+    # Keep, for every sample, the best hypothesis ending with eos (or any hypothesis if eos_token_id
+    # is None) by length-normalized score, and drop the finished hypotheses from the beams
+    batch_size, num_beams = beam_scores.shape
+    cur_len = history.shape[-1]
+    if eos_token_id is None:
+        finished = torch.ones(history.shape[0], dtype=torch.bool, device=history.device)
+    else:
+        eos = torch.tensor(eos_token_id, device=history.device)
+        finished = (history[:, -1:] == eos).any(dim=-1)
+
+    _score = beam_scores.view(-1) / cur_len ** length_penalty
+    # Finished hypotheses of -inf score are still taken by a sample without a candidate yet
+    _score = torch.where(finished, _score.clamp(min=torch.finfo(_score.dtype).min), _score.new_tensor(-float("inf")))
+    cand_score, cand_beam = _score.view(batch_size, num_beams).max(dim=1)
+    improve = finished.view(batch_size, num_beams).any(dim=1) & (~has_best | (cand_score > best_score))
+
+    rows = cand_beam + torch.arange(batch_size, device=history.device) * num_beams
+    best_score.copy_(torch.where(improve, cand_score, best_score))
+    best_sequence[:, :cur_len] = torch.where(improve.unsqueeze(1), history[rows], best_sequence[:, :cur_len])
+    has_best |= improve
+
+    beam_scores.view(-1).masked_fill_(finished, -float("inf"))
+
+
+def _is_done(best_score, has_best, beam_scores, cur_len, max_len, length_penalty=1.0):
+    # A sample is done when no live hypothesis can beat its best finished one. Beam scores only
+    # decrease, so the best normalized score a hypothesis can reach is its current score over the
+    # longest length if length_penalty > 0, or over the next length otherwise.
+    best_live = beam_scores.max(dim=1).values
+    best_reachable = best_live / (max_len if length_penalty > 0 else cur_len + 1) ** length_penalty
+    return has_best & (best_score >= best_reachable)
 
 
 def beam(model, data_iter, args):
@@ -233,11 +342,17 @@ def beam(model, data_iter, args):
             
             past = None
             len_past = None
+            if args.paged_kv_cache:
+                past = model.transformer.allocate_paged_kv_cache(args.kv_cache_blocks, args.kv_block_size)
+            elif args.static_kv_cache:
+                past = model.transformer.allocate_kv_cache(batch_size * num_beams, _query.shape[1] + args.eval_len)
 
+            _prompt, _prompt_len = _query, _query_len
             _query = _query.repeat(1, num_beams).view(batch_size * num_beams, -1)
             _query_len = _query_len.unsqueeze(-1).repeat(1, num_beams).view(-1)
 
-            _bbatch = _batch.unsqueeze(-1).repeat(1, num_beams).view(-1)
+            # Rows of the beams, which start as num_beams copies of every query
+            _bbatch = torch.arange(0, batch_size * num_beams, device=args.device, dtype=torch.long)
             
             # scores for each sentence in the beam
             beam_scores = torch.zeros(
@@ -247,13 +362,34 @@ def beam(model, data_iter, args):
             best_sequence = torch.zeros(
                 (batch_size, args.eval_len), dtype=torch.long, device=_query.device
             )
-            best_score = {}
+            # best_sequence and the other per-sample state only cover the samples still decoding,
+            # _active maps them to the rows of output_sequence
+            output_sequence = torch.zeros_like(best_sequence)
+            _active = _batch
+            best_score = torch.full((batch_size, ), -float("inf"), device=_query.device)
+            has_best = torch.zeros((batch_size, ), dtype=torch.bool, device=_query.device)
 
             history = None
+            ngram_blocker = None
+            if args.no_repeat_ngram_size > 0:
+                ngram_blocker = NgramBlocker(
+                    args.no_repeat_ngram_size, batch_size * num_beams, args.eval_len, device=_query.device
+                )
+            processors = logits_processors(args, ngram_blocker=ngram_blocker)
             with torch.no_grad():
                 for i in range(0, args.eval_len):
-                    if i == 0:
-                        logits, past = model(_query) 
+                    if i == 0 and args.paged_kv_cache:
+                        # Run every prompt once, from the longest prefix already in the cache,
+                        # then let the beams share its blocks
+                        past.start(batch_size)
+                        start = past.match_prefix(_prompt, _prompt_len)
+                        logits, past = model(_prompt[:, start:], past=past)
+                        past.register_prefix(_prompt, _prompt_len)
+                        logits = logits[_batch, (_prompt_len-1-start).long(), :]
+                        logits = logits.repeat_interleave(num_beams, dim=0) # batch_size * beam, vocab
+                        past.fork(num_beams)
+                    elif i == 0:
+                        logits, past = model(_query, past=past) 
                         logits = logits[_bbatch, (_query_len-1).long(), :] # batch_size * beam, vocab
                     else:
                         #print('token_id.shape', token_id.shape, token_id)
@@ -263,17 +399,7 @@ def beam(model, data_iter, args):
                         logits, past = model(token_id, past=past, len_past=len_past) 
                         logits = logits[:, -1, :]    # batch_size * beam, vocab
 
-                    logits = _postprocess_next_token_scores(           
-                        logits,
-                        history,
-                        i,
-                        batch_size,
-                        num_beams,
-                        repetition_penalty=args.repetition_penalty,                                
-                        no_repeat_ngram_size=args.no_repeat_ngram_size,
-                        min_length=args.min_length,
-                        eos_token_id=args.eos_token_id,
-                    )
+                    logits = processors(logits, history, i)
 
                     softmax_probs = F.softmax(logits, dim=-1)
                     ##_prob, _w_idx = torch.topk(softmax_probs, num_beams) # batch_size, beam
@@ -305,38 +431,130 @@ def beam(model, data_iter, args):
                         history = token_id.detach()
                     else:
                         history = torch.cat((history[beam_idx.view(-1)], token_id.detach()), dim=1).detach()
+                    if ngram_blocker is not None:
+                        ngram_blocker.update(beam_idx.view(-1), history)
 
                     _add_beam_candidate(
-                        best_score, best_sequence, batch_size, num_beams, beam_scores, history, 
-                        eos_token_id=args.eos_token_id
+                        best_score, best_sequence, has_best, beam_scores, history, 
+                        length_penalty=length_penalty, eos_token_id=args.eos_token_id
                     )
-                
-                _add_beam_candidate(
-                    best_score, best_sequence, batch_size, num_beams, beam_scores, history
-                )
 
+                    done = _is_done(best_score, has_best, beam_scores, i + 1, args.eval_len, length_penalty)
+                    if i + 1 < args.eval_len and done.any():
+                        # Drop the finished samples from the batch and from the cache
+                        output_sequence[_active[done]] = best_sequence[done]
+                        keep = (~done).nonzero().view(-1)
+                        if keep.numel() == 0:
+                            break
+                        rows = (keep.unsqueeze(1) * num_beams + torch.arange(num_beams, device=keep.device)).view(-1)
+                        past = _reorder_cache(past, rows)
+                        if ngram_blocker is not None:
+                            ngram_blocker.reorder_(rows)
+                        history, token_id = history[rows], token_id[rows]
+                        _query_len, len_past = _query_len[rows], len_past[rows]
+                        _active, beam_scores, best_sequence = _active[keep], beam_scores[keep], best_sequence[keep]
+                        best_score, has_best = best_score[keep], has_best[keep]
+                        batch_size = keep.numel()
+                        _batch = torch.arange(0, batch_size, device=args.device, dtype=torch.long)
+
+                if _active.numel() > 0:
+                    _add_beam_candidate(
+                        best_score, best_sequence, has_best, beam_scores, history, length_penalty=length_penalty
+                    )
+                    output_sequence[_active] = best_sequence
+
+            _collect_predictions(args, all_predictions, idx, _id, output_sequence)
+
+    _save_predictions(args, all_predictions)
+
+
+def sample(model, data_iter, args):
+    # Greedy decoding or sampling of one sequence per sample. Without beams there are no scores,
+    # candidates or cache reordering: finished samples keep their rows, feeding padding, until all
+    # samples of the batch are finished.
+    model.eval()
+    all_predictions = {}
+    with torch.no_grad():
+        for idx, data in enumerate(data_iter):
+            _id = data['id'].to(args.device)
+            _query = data['query'].to(args.device)
+            _query_len = data['query_len'].to(args.device)
+
+            batch_size = _id.size(0)
+            _batch = torch.arange(0, batch_size, device=args.device, dtype=torch.long)
+
+            past = None
+            start = 0
+            if args.paged_kv_cache:
+                past = model.transformer.allocate_paged_kv_cache(args.kv_cache_blocks, args.kv_block_size)
+                past.start(batch_size)
+                start = past.match_prefix(_query, _query_len)
+            elif args.static_kv_cache:
+                past = model.transformer.allocate_kv_cache(batch_size, _query.shape[1] + args.eval_len)
+
+            eos = torch.tensor(args.eos_token_id, device=args.device)
+            output_sequence = torch.zeros((batch_size, args.eval_len), dtype=torch.long, device=args.device)
+            finished = torch.zeros((batch_size, ), dtype=torch.bool, device=args.device)
+
+            ngram_blocker = None
+            if args.no_repeat_ngram_size > 0:
+                ngram_blocker = NgramBlocker(args.no_repeat_ngram_size, batch_size, args.eval_len, device=args.device)
+            processors = logits_processors(args, ngram_blocker=ngram_blocker, sampling=args.decode == 'sample')
+
+            for i in range(0, args.eval_len):
+                if i == 0:
+                    logits, past = model(_query[:, start:], past=past)
+                    if args.paged_kv_cache:
+                        past.register_prefix(_query, _query_len)
+                    logits = logits[_batch, (_query_len-1-start).long(), :]
+                else:
+                    logits, past = model(token_id, past=past, len_past=len_past)
+                    logits = logits[:, -1, :]
+
+                logits = processors(logits, output_sequence[:, :i] if i > 0 else None, i)
+                if args.decode == 'greedy':
+                    next_token = logits.argmax(dim=-1)
+                else:
+                    next_token = torch.multinomial(F.softmax(logits.float(), dim=-1), 1).squeeze(-1)
+
+                output_sequence[:, i] = next_token.masked_fill_(finished, 0)
+                if ngram_blocker is not None:
+                    ngram_blocker.update(None, output_sequence[:, :i + 1])
+                finished |= (next_token.unsqueeze(-1) == eos).any(dim=-1)
+                if bool(finished.all()):
+                    break
+                token_id = next_token.unsqueeze(-1)
+                len_past = (_query_len + i).long()
+
+            _collect_predictions(args, all_predictions, idx, _id, output_sequence)
+
+    _save_predictions(args, all_predictions)
+
+
+def _collect_predictions(args, all_predictions, idx, _id, output_sequence):
+    with torch.no_grad():
+        _id = distributed_gather(args, _id)
+        output = distributed_gather(args, output_sequence)
+        #score = distributed_gather(args, score)
+        distributed_sync(args)
+
+    if args.rank == 0:
+        _id = _id.view(-1).cpu()
+        output = output.view(-1, output.shape[-1]).cpu()
+        #score = score.view(-1, score.shape[-1]).cpu()
+
+        for _b in range(0, _id.shape[-1]):
+            _i = int(_id[_b].item())
+            all_predictions[_i] = {}
+            all_predictions[_i]['id'] = _i
+            all_predictions[_i]['predict'] = output[_b].tolist()
+            #all_predictions[_i]['score'] = score[_b].tolist()
+
+        if idx % 10 == 0:
+            print('inference samples', idx)
 
-            with torch.no_grad():
-                _id = distributed_gather(args, _id)
-                output = distributed_gather(args, best_sequence)
-                #score = distributed_gather(args, score)
-                distributed_sync(args)
-
-            if args.rank == 0:
-                _id = _id.view(-1).cpu()
-                output = output.view(-1, output.shape[-1]).cpu()
-                #score = score.view(-1, score.shape[-1]).cpu()
-
-                for _b in range(0, _id.shape[-1]):
-                    _i = int(_id[_b].item())
-                    all_predictions[_i] = {}
-                    all_predictions[_i]['id'] = _i
-                    all_predictions[_i]['predict'] = output[_b].tolist()
-                    #all_predictions[_i]['score'] = score[_b].tolist()
-
-                if idx % 10 == 0:
-                    print('inference samples', idx)
 
+def _save_predictions(args, all_predictions):
     if args.rank == 0:
         pred_file = os.path.join(args.work_dir, args.output_file) 
         print('saving prediction file', pred_file)
@@ -366,27 +584,34 @@ if __name__ == '__main__':
         config = GPT2Config(
             n_embd=768, n_layer=12, n_head=12, 
             lora_attn_dim=args.lora_dim, lora_attn_alpha=args.lora_alpha,
+            fused_attn=args.fused_attn,
         )
     elif args.model_card == 'gpt2.md':
         config = GPT2Config(
             n_embd=1024, n_layer=24, n_head=16, 
             lora_attn_dim=args.lora_dim, lora_attn_alpha=args.lora_alpha,
+            fused_attn=args.fused_attn,
         )
     elif args.model_card == 'gpt2.lg':
         config = GPT2Config(
             n_embd=1280, n_layer=36, n_head=20, 
             lora_attn_dim=args.lora_dim, lora_attn_alpha=args.lora_alpha,
+            fused_attn=args.fused_attn,
         )
 
-    lm_net = GPT2LMModel(config)
     if args.init_checkpoint is not None:
         print('loading model pretrained weight.')
-        cp = torch.load(args.init_checkpoint, map_location=torch.device('cpu'))
-        lm_net.load_weight(cp)    
+        cp = load_checkpoint(args.init_checkpoint)
+        lm_net = GPT2LMModel.from_pretrained(config, cp, device=args.device)
+    else:
+        lm_net = GPT2LMModel(config)
     lm_net = lm_net.cuda()
 
     print('model sampling ...')
-    beam(lm_net, valid_loader, args)
+    if args.decode == 'beam':
+        beam(lm_net, valid_loader, args)
+    else:
+        sample(lm_net, valid_loader, args)
     distributed_sync(args)
     print('cleanup dist ...')
     cleanup(args)
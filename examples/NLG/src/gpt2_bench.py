@@ -0,0 +1,162 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import argparse
+import time
+
+import torch
+
+from model import Attention, GPT2Config, GPT2LMModel
+
+import loralib as lora
+
+
+parser = argparse.ArgumentParser(description='PyTorch GPT2 benchmarks')
+
+parser.add_argument('--bench', default='train_step', choices=['train_step', 'attention', 'checkpoint'],
+                    help='benchmark to run')
+
+parser.add_argument('--model_card', nargs='+', default=['gpt2.md', 'gpt2.lg'],
+                    choices=['gpt2.sm', 'gpt2.md', 'gpt2.lg'], help='model names')
+
+parser.add_argument('--batch_size', type=int, default=8, help='batch size')
+
+parser.add_argument('--seq_len', type=int, default=512, help='sequence length')
+
+parser.add_argument('--lora_dim', type=int, default=4, help='lora attn dimension')
+
+parser.add_argument('--lora_alpha', type=int, default=32, help='lora attn alpha')
+
+parser.add_argument('--checkpoint_every', type=int, nargs='+', default=[0, 4, 2, 1], 
+                    help='activation checkpointing settings to compare, 0 disables it')
+
+parser.add_argument('--repeat', type=int, default=10, help='timed iterations per configuration')
+
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu',
+                    help='device to run on')
+
+
+def get_config(model_card, args):
+    if model_card == 'gpt2.sm':
+        return GPT2Config(
+            n_embd=768, n_layer=12, n_head=12,
+            lora_attn_dim=args.lora_dim, lora_attn_alpha=args.lora_alpha,
+        )
+    elif model_card == 'gpt2.md':
+        return GPT2Config(
+            n_embd=1024, n_layer=24, n_head=16,
+            lora_attn_dim=args.lora_dim, lora_attn_alpha=args.lora_alpha,
+        )
+    elif model_card == 'gpt2.lg':
+        return GPT2Config(
+            n_embd=1280, n_layer=36, n_head=20,
+            lora_attn_dim=args.lora_dim, lora_attn_alpha=args.lora_alpha,
+        )
+
+
+def timeit(fn, repeat, device):
+    # Warm up once, then report the mean wall time in milliseconds
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def random_batch(config, args, device):
+    _input = torch.randint(0, config.vocab_size, (args.batch_size, args.seq_len), device=device)
+    _target = torch.randint(0, config.vocab_size, (args.batch_size, args.seq_len), device=device)
+    _msk = torch.ones(args.batch_size, args.seq_len, device=device)
+    return _input, _target, _msk
+
+
+def train_step(model, _input, _target, _msk):
+    _lm_logits, _lm_loss = model(_input, lm_labels=_target, lm_mask=_msk)
+    _lm_loss.backward()
+
+
+def bench_attention(args, device):
+    # Compares the fused attention path against the matmul/softmax one on the forward and backward of the model
+    print(f'{"model":>8} {"seq":>6} | {"eager":>10} {"fused":>10} (ms/step) | {"eager":>8} {"fused":>8} (peak MB)')
+    for model_card in args.model_card:
+        config = get_config(model_card, args)
+        lm_net = GPT2LMModel(config).to(device)
+        lora.mark_only_lora_as_trainable(lm_net)
+        lm_net.train()
+        _input, _target, _msk = random_batch(config, args, device)
+
+        timings, peaks = [], []
+        for fused_attn in [False, True]:
+            # Every block holds a copy of the config, made when the model is built
+            for m in lm_net.modules():
+                if isinstance(m, Attention):
+                    m.config.fused_attn = fused_attn
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(device)
+            timings.append(timeit(lambda: train_step(lm_net, _input, _target, _msk), args.repeat, device))
+            peaks.append(torch.cuda.max_memory_allocated(device) / 2**20 if device.type == 'cuda' else float('nan'))
+            lm_net.zero_grad()
+        print(
+            f'{model_card:>8} {args.seq_len:>6} | {timings[0]:10.2f} {timings[1]:10.2f}           '
+            f' | {peaks[0]:8.0f} {peaks[1]:8.0f}'
+        )
+        del lm_net
+
+
+def bench_checkpoint(args, device):
+    # Time and peak memory of a training step with activation checkpointing of every k-th block
+    print(f'{"model":>8} {"every":>6} | {"ms/step":>10} {"peak MB":>10}')
+    for model_card in args.model_card:
+        config = get_config(model_card, args)
+        lm_net = GPT2LMModel(config).to(device)
+        lora.mark_only_lora_as_trainable(lm_net)
+        lm_net.train()
+        _input, _target, _msk = random_batch(config, args, device)
+
+        for every in args.checkpoint_every:
+            config.checkpoint_every = every
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(device)
+            timing = timeit(lambda: train_step(lm_net, _input, _target, _msk), args.repeat, device)
+            peak = torch.cuda.max_memory_allocated(device) / 2**20 if device.type == 'cuda' else float('nan')
+            lm_net.zero_grad()
+            print(f'{model_card:>8} {every:>6} | {timing:10.2f} {peak:10.0f}')
+        del lm_net
+
+
+def bench_train_step(args, device):
+    # Compares the low-rank MergedLinear path of c_attn against building delta-W on every step
+    print(f'{"model":>8} | {"delta-W":>10} {"low-rank":>10} (ms/step) | speedup')
+    for model_card in args.model_card:
+        config = get_config(model_card, args)
+        lm_net = GPT2LMModel(config).to(device)
+        lora.mark_only_lora_as_trainable(lm_net)
+        lm_net.train()
+        _input, _target, _msk = random_batch(config, args, device)
+
+        timings = []
+        for low_rank in [False, True]:
+            for m in lm_net.modules():
+                if isinstance(m, lora.MergedLinear):
+                    m.low_rank = low_rank
+            timings.append(timeit(lambda: train_step(lm_net, _input, _target, _msk), args.repeat, device))
+            lm_net.zero_grad()
+        print(f'{model_card:>8} | {timings[0]:10.2f} {timings[1]:10.2f}            | {timings[0] / timings[1]:.2f}x')
+        del lm_net
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    if args.bench == 'train_step':
+        bench_train_step(args, device)
+    elif args.bench == 'attention':
+        bench_attention(args, device)
+    elif args.bench == 'checkpoint':
+        bench_checkpoint(args, device)
@@ -30,7 +30,7 @@ from optimizer import (
 )
 
 from data_utils import FT_Dataset
-from model import GPT2Config, GPT2LMModel
+from model import GPT2Config, GPT2LMModel, load_checkpoint
 from exp_utils import create_exp_dir
 
 import loralib as lora
@@ -74,6 +74,14 @@ parser.add_argument('--lora_dim', type=int, default=0, help='lora attn dimension
 
 parser.add_argument('--lora_alpha', type=int, default=128, help='lora attn alpha')
 
+parser.add_argument('--fused_attn', action='store_true', help='use the fused attention kernel')
+
+parser.add_argument('--checkpoint_every', type=int, default=0, 
+                    help='recompute the activations of every k-th transformer block in backward, 0 to disable')
+
+parser.add_argument('--checkpoint_budget', type=int, default=0, 
+                    help='recompute the activations of enough blocks to keep the others within this many MB')
+
 parser.add_argument('--obj', default='clm', choices=['jlm', 'clm'], 
                     help='language model training objective')
 
@@ -82,6 +90,9 @@ parser.add_argument('--lora_dropout', default=0.0, type=float,
 
 parser.add_argument('--label_smooth', default=0.0, type=float, help='label smoothing')
 
+parser.add_argument('--loss_chunk_size', default=0, type=int, 
+                    help='compute the training loss over chunks of this many target tokens, 0 to disable')
+
 parser.add_argument('--roll_interval', type=int, default=-1, help='rolling interval')
 
 parser.add_argument('--roll_lr', type=float, default=0.00001, help='rolling learning rate')
@@ -155,7 +166,7 @@ def evaluate(model, valid_loader, args):
             _target = data['target'].to(args.device)
             _msk = data['mask'].to(args.device)
 
-            _lm_logits, _loss = model(_input, lm_labels=_target, lm_mask=_msk) 
+            _lm_logits, _loss = model(_input, lm_labels=_target, lm_mask=_msk, loss_chunk_size=args.loss_chunk_size) 
             loss = _loss.mean() 
             
             avg_lm_loss.update(loss.item())
@@ -194,7 +205,8 @@ def train_validate(
         _msk = data['mask'].to(args.device)
 
         _lm_logits, _lm_loss = model(
-            _input, lm_labels=_target, lm_mask=_msk, label_smooth=args.label_smooth
+            _input, lm_labels=_target, lm_mask=_msk, label_smooth=args.label_smooth, 
+            loss_chunk_size=args.loss_chunk_size
         ) 
 
         _lm_loss = _lm_loss.mean() 
@@ -302,6 +314,9 @@ if __name__ == '__main__':
             lora_attn_dim=args.lora_dim, 
             lora_attn_alpha=args.lora_alpha, 
             lora_dropout=args.lora_dropout,
+            fused_attn=args.fused_attn,
+            checkpoint_every=args.checkpoint_every,
+            checkpoint_budget=args.checkpoint_budget,
         )
     elif args.model_card == 'gpt2.md':
         config = GPT2Config(
@@ -309,6 +324,9 @@ if __name__ == '__main__':
             lora_attn_dim=args.lora_dim, 
             lora_attn_alpha=args.lora_alpha, 
             lora_dropout=args.lora_dropout,
+            fused_attn=args.fused_attn,
+            checkpoint_every=args.checkpoint_every,
+            checkpoint_budget=args.checkpoint_budget,
         )
     elif args.model_card == 'gpt2.lg':
         config = GPT2Config(
@@ -316,12 +334,16 @@ if __name__ == '__main__':
             lora_attn_dim=args.lora_dim, 
             lora_attn_alpha=args.lora_alpha, 
             lora_dropout=args.lora_dropout,
+            fused_attn=args.fused_attn,
+            checkpoint_every=args.checkpoint_every,
+            checkpoint_budget=args.checkpoint_budget,
         )
 
-    lm_net = GPT2LMModel(config)
     if args.init_checkpoint is not None:
         print('loading model pretrained weight.')
-        lm_net.load_weight(torch.load(args.init_checkpoint))    
+        lm_net = GPT2LMModel.from_pretrained(config, load_checkpoint(args.init_checkpoint), device=args.device)
+    else:
+        lm_net = GPT2LMModel(config)
 
     lm_net = lm_net.cuda()
 
@@ -0,0 +1,347 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import argparse
+import asyncio
+import json
+
+import torch
+
+import encoder
+from model import GPT2Config, GPT2LMModel, load_checkpoint
+
+import loralib as lora
+
+
+parser = argparse.ArgumentParser(description='PyTorch GPT2 generation server')
+
+parser.add_argument('--model_card', default='gpt2.sm', choices=['gpt2.sm', 'gpt2.md', 'gpt2.lg'],
+                    help='model names')
+
+parser.add_argument('--init_checkpoint', default=None, type=str, help='initial checkpoint')
+
+parser.add_argument('--lora_dim', type=int, default=0, help='lora attn dimension')
+
+parser.add_argument('--lora_alpha', type=int, default=128, help='lora attn alpha')
+
+parser.add_argument('--adapter', action='append', default=[],
+                    help='LoRA checkpoint to serve, as name=path; requests select it by name')
+
+parser.add_argument('--fused_attn', action='store_true', help='use the fused attention kernel')
+
+parser.add_argument('--max_batch_size', type=int, default=16, help='maximum number of running sequences')
+
+parser.add_argument('--max_len', type=int, default=512, help='maximum length of prompt and generation')
+
+parser.add_argument('--eos_token_id', action='append', type=int, default=[50256],
+                    help='eos token id')
+
+parser.add_argument('--vocab', type=str, default=None, help='vocab path, to accept and return text')
+
+parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+
+parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu',
+                    help='device to run on')
+
+
+class GenerationRequest(object):
+    def __init__(self, prompt, max_new_tokens, adapter=None):
+        self.prompt = list(prompt)
+        self.max_new_tokens = max_new_tokens
+        self.adapter = adapter
+        self.generated = 0
+        # Set when the client went away, the engine then frees the row of the request
+        self.cancelled = False
+        # Generated tokens, then None once the request is finished
+        self.tokens = asyncio.Queue()
+
+
+class GenerationEngine(object):
+    # Greedy generation with continuous batching. The running sequences occupy the first rows of a
+    # StaticKVCache and advance by one token per step, each at its own position through len_past.
+    # A finished sequence hands its row to the last one right away, and waiting requests are
+    # prefilled into the free rows before the next step, so the batch stays full under load.
+    def __init__(self, model, max_batch_size=16, max_len=512, eos_token_id=(50256, )):
+        assert max_len <= model.transformer.config.n_positions, 'max_len exceeds the positions of the model'
+        self.model = model.eval()
+        self.vocab_size = model.transformer.config.vocab_size
+        self.device = model.transformer.wte.weight.device
+        self.max_batch_size = max_batch_size
+        self.max_len = max_len
+        self.eos_token_id = set(eos_token_id)
+        self.cache = model.transformer.allocate_kv_cache(max_batch_size, max_len)
+        self.cache.reset(0)
+        # Running requests in the order of the rows of the cache, their next position and last token
+        self.running, self.positions, self.last_tokens = [], [], []
+        self.waiting = asyncio.Queue()
+        self.adapters = {}
+
+    def register_adapter(self, name, state_dict):
+        # Rows of requests without adapter use the pretrained weights only, see lora.set_adapter_index()
+        state_dict = {k[len('module.'):] if k.startswith('module.') else k: v for k, v in state_dict.items()}
+        self.adapters[name] = lora.register_adapter(self.model, name, state_dict)
+
+    def _set_adapter_index(self, requests):
+        if self.adapters:
+            lora.set_adapter_index(self.model, torch.tensor(
+                [self.adapters[r.adapter] if r.adapter is not None else -1 for r in requests], device=self.device
+            ))
+
+    def _is_finished(self, row, token):
+        request = self.running[row]
+        return token in self.eos_token_id or request.generated >= request.max_new_tokens or \
+            self.positions[row] >= self.max_len
+
+    def _prefill(self, request):
+        row = len(self.running)
+        self._set_adapter_index([request])
+        logits, presents = self.model(torch.tensor([request.prompt], device=self.device))
+        self.cache.write_row_(row, presents)
+        token = int(logits[0, -1].argmax())
+        request.generated += 1
+        self.running.append(request)
+        self.positions.append(len(request.prompt))
+        self.last_tokens.append(token)
+        return token
+
+    def _decode(self):
+        self.cache.rows = len(self.running)
+        self.cache.length = max(self.positions)
+        self._set_adapter_index(self.running)
+        logits, _ = self.model(
+            torch.tensor(self.last_tokens, device=self.device).unsqueeze(1),
+            past=self.cache,
+            len_past=torch.tensor(self.positions, device=self.device)
+        )
+        tokens = logits[:, -1].argmax(dim=-1).tolist()
+        for row, token in enumerate(tokens):
+            self.running[row].generated += 1
+            self.positions[row] += 1
+            self.last_tokens[row] = token
+        return tokens
+
+    def _release(self, rows):
+        # Move the last running sequence into every released row
+        for row in sorted(rows, reverse=True):
+            last = len(self.running) - 1
+            if row != last:
+                self.cache.move_row_(last, row, self.positions[last])
+                self.running[row] = self.running[last]
+                self.positions[row] = self.positions[last]
+                self.last_tokens[row] = self.last_tokens[last]
+            self.running.pop()
+            self.positions.pop()
+            self.last_tokens.pop()
+        self.cache.rows = len(self.running)
+
+    @torch.no_grad()
+    def step(self, new_requests):
+        # Generate one token for every running request, then admit new_requests into the free rows.
+        # Returns the (request, token, finished) of this step, in the order of the rows, followed by
+        # (request, None, True) for the requests that failed, which are dropped from the batch.
+        self._release([row for row, request in enumerate(self.running) if request.cancelled])
+        events, failed = [], []
+        if self.running:
+            try:
+                events = list(zip(self.running, self._decode()))
+            except Exception as e:
+                # The step of the whole batch failed, so all running requests end
+                print(f'decoding failed: {e!r}')
+                failed = list(self.running)
+                self._release(range(len(self.running)))
+        for request in new_requests:
+            try:
+                events.append((request, self._prefill(request)))
+            except Exception as e:
+                # _prefill() only adds the request to the batch once it succeeded
+                print(f'prefill failed: {e!r}')
+                failed.append(request)
+
+        results = [(request, token, self._is_finished(row, token)) for row, (request, token) in enumerate(events)]
+        self._release([row for row, (_, _, finished) in enumerate(results) if finished])
+        return results + [(request, None, True) for request in failed]
+
+    async def generate(self, prompt, max_new_tokens=64, adapter=None):
+        # Streams the tokens generated for prompt, a list of token ids. Raises ValueError for invalid
+        # arguments; the stream ends early if generation fails.
+        if adapter is not None and adapter not in self.adapters:
+            raise ValueError(f'Unknown adapter {adapter}')
+        if not isinstance(prompt, (list, tuple)) or not 0 < len(prompt) < self.max_len:
+            raise ValueError(f'The prompt must be a list of 1 to {self.max_len - 1} token ids')
+        if not all(type(t) is int and 0 <= t < self.vocab_size for t in prompt):
+            raise ValueError(f'The token ids of the prompt must be integers in [0, {self.vocab_size})')
+        if type(max_new_tokens) is not int or max_new_tokens < 1:
+            raise ValueError('max_new_tokens must be a positive integer')
+        request = GenerationRequest(prompt, max_new_tokens, adapter=adapter)
+        await self.waiting.put(request)
+        finished = False
+        try:
+            while True:
+                token = await request.tokens.get()
+                if token is None:
+                    finished = True
+                    return
+                yield token
+        finally:
+            # The generator was closed before the end, e.g. after a disconnection
+            if not finished:
+                request.cancelled = True
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            new_requests = []
+            if not self.running:
+                new_requests.append(await self.waiting.get())
+            while len(self.running) + len(new_requests) < self.max_batch_size and not self.waiting.empty():
+                new_requests.append(self.waiting.get_nowait())
+            new_requests = [request for request in new_requests if not request.cancelled]
+            if not self.running and not new_requests:
+                continue
+            # The model runs in a worker thread, so that requests keep being accepted meanwhile
+            try:
+                results = await loop.run_in_executor(None, self.step, new_requests)
+            except Exception as e:
+                # Never let a failure stop the loop: end every request of the step, and start over
+                print(f'generation step failed: {e!r}')
+                results = [(request, None, True) for request in self.running + new_requests]
+                self.running, self.positions, self.last_tokens = [], [], []
+                self.cache.reset(0)
+            for request, token, finished in results:
+                if token is not None:
+                    request.tokens.put_nowait(token)
+                if finished:
+                    request.tokens.put_nowait(None)
+
+
+async def _respond(writer, status, body=b'', headers=()):
+    # Every connection serves one request, then is closed
+    writer.write(f'HTTP/1.1 {status}\r\nConnection: close\r\n'.encode())
+    for header in headers:
+        writer.write(f'{header}\r\n'.encode())
+    if not any(header.startswith('Transfer-Encoding') for header in headers):
+        writer.write(f'Content-Length: {len(body)}\r\n'.encode())
+    writer.write(b'\r\n' + body)
+    await writer.drain()
+
+
+def http_handler(engine, enc=None):
+    # A minimal HTTP front-end for testing: POST /generate with a JSON body
+    #   {"prompt": [token ids] or "text": "...", "max_new_tokens": 64, "adapter": null}
+    # streams one JSON line per generated token.
+    async def handle(reader, writer):
+        tokens = None
+        try:
+            try:
+                method, path, _ = (await reader.readline()).decode().split()
+                content_length = 0
+                while True:
+                    line = (await reader.readline()).decode().strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(':')
+                    if name.lower() == 'content-length':
+                        content_length = int(value)
+                if method != 'POST' or path != '/generate':
+                    await _respond(writer, '404 Not Found', b'Not Found')
+                    return
+                body = json.loads(await reader.readexactly(content_length))
+                if 'prompt' in body:
+                    prompt = body['prompt']
+                elif enc is not None:
+                    prompt = enc.encode(body['text'])
+                else:
+                    await _respond(writer, '400 Bad Request', b'Start the server with --vocab to send text')
+                    return
+                tokens = engine.generate(
+                    prompt, max_new_tokens=body.get('max_new_tokens', 64), adapter=body.get('adapter')
+                )
+                # Get the first token before answering, so that invalid requests are rejected
+                token = await tokens.__anext__()
+            except (ValueError, KeyError, TypeError) as e:
+                await _respond(writer, '400 Bad Request', str(e).encode())
+                return
+            except StopAsyncIteration:
+                await _respond(writer, '500 Internal Server Error', b'Generation failed')
+                return
+
+            await _respond(
+                writer, '200 OK', headers=['Content-Type: application/x-ndjson', 'Transfer-Encoding: chunked']
+            )
+            while True:
+                message = {'token': token}
+                if enc is not None:
+                    message['text'] = enc.decode([token])
+                chunk = (json.dumps(message) + '\n').encode()
+                writer.write(f'{len(chunk):x}\r\n'.encode() + chunk + b'\r\n')
+                await writer.drain()
+                if writer.is_closing():
+                    return
+                try:
+                    token = await tokens.__anext__()
+                except StopAsyncIteration:
+                    break
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            # Closing the generator of a request still decoding cancels it, see generate()
+            if tokens is not None:
+                await tokens.aclose()
+            writer.close()
+
+    return handle
+
+
+async def serve(engine, host, port, enc=None):
+    server = await asyncio.start_server(http_handler(engine, enc=enc), host, port)
+    print(f'serving on http://{host}:{port}/generate')
+    async with server:
+        await asyncio.gather(server.serve_forever(), engine.run())
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.model_card == 'gpt2.sm':
+        config = GPT2Config(
+            n_embd=768, n_layer=12, n_head=12, 
+            lora_attn_dim=args.lora_dim, lora_attn_alpha=args.lora_alpha,
+            fused_attn=args.fused_attn,
+        )
+    elif args.model_card == 'gpt2.md':
+        config = GPT2Config(
+            n_embd=1024, n_layer=24, n_head=16, 
+            lora_attn_dim=args.lora_dim, lora_attn_alpha=args.lora_alpha,
+            fused_attn=args.fused_attn,
+        )
+    elif args.model_card == 'gpt2.lg':
+        config = GPT2Config(
+            n_embd=1280, n_layer=36, n_head=20, 
+            lora_attn_dim=args.lora_dim, lora_attn_alpha=args.lora_alpha,
+            fused_attn=args.fused_attn,
+        )
+
+    if args.init_checkpoint is not None:
+        print('loading model pretrained weight.')
+        lm_net = GPT2LMModel.from_pretrained(config, load_checkpoint(args.init_checkpoint), device=args.device)
+    else:
+        lm_net = GPT2LMModel(config).to(args.device)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    engine = GenerationEngine(
+        lm_net, max_batch_size=args.max_batch_size, max_len=args.max_len, eos_token_id=args.eos_token_id
+    )
+    for adapter in args.adapter:
+        name, _, path = adapter.partition('=')
+        cp = load_checkpoint(path)
+        print(f'loading adapter {name}.')
+        engine.register_adapter(name, cp.get('model_state_dict', cp))
+
+    enc = encoder.get_encoder(args.vocab) if args.vocab is not None else None
+    loop.run_until_complete(serve(engine, args.host, args.port, enc=enc))
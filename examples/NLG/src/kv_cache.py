@@ -0,0 +1,295 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+from collections import OrderedDict
+
+import torch
+from torch import Tensor
+
+
+class KVCache(object):
+    # A cache passed to GPT2Model as past. advance() is called once per forward pass, then every
+    # Attention calls update() on its layer with its new keys and values.
+    def __init__(self, n_layer, layer_cls):
+        # Number of positions in use, the same for all rows of the batch
+        self.length = 0
+        self.layers = [layer_cls(self, i) for i in range(n_layer)]
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __getitem__(self, i):
+        return self.layers[i]
+
+    def advance(self, seq_len, len_past=None):
+        # Called before the layers write seq_len new positions, either after the positions in use
+        # or, when decoding one token per row, at the positions len_past
+        if len_past is None:
+            self.length += seq_len
+        else:
+            self.length = max(self.length, int(len_past.max()) + 1)
+
+    def reorder_(self, beam_idx: Tensor):
+        raise NotImplementedError
+
+
+class LayerKVCache(object):
+    # The cache of one layer, passed to Attention as its layer_past
+    def __init__(self, cache: KVCache, layer: int):
+        self.cache = cache
+        self.layer = layer
+
+    def update(self, key: Tensor, value: Tensor, len_past: Tensor = None):
+        # key, value : (batch, head, seq_length, head_features)
+        # Returns the cached keys and values of the positions in use
+        raise NotImplementedError
+
+
+class StaticKVCache(KVCache):
+    # Preallocated keys and values of all layers, (batch, n_layer, head, max_len, head_features).
+    # New keys and values are written in place, and beams are reordered by gathering into a second
+    # buffer of the same size which then becomes the cache, so decoding does not allocate. Reordering
+    # may keep fewer rows, which then use the first rows of the buffers.
+    def __init__(self, n_layer, batch_size, n_head, max_len, head_features, dtype=None, device=None):
+        shape = (batch_size, n_layer, n_head, max_len, head_features)
+        # Zeros, as masked positions never written to still enter attention with weight 0
+        self._keys = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(2)]
+        self._values = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(2)]
+        self.rows = batch_size
+        super(StaticKVCache, self).__init__(n_layer, StaticLayerKVCache)
+
+    @property
+    def key(self):
+        return self._keys[0][:self.rows]
+
+    @property
+    def value(self):
+        return self._values[0][:self.rows]
+
+    @property
+    def batch_size(self):
+        return self._keys[0].shape[0]
+
+    @property
+    def max_len(self):
+        return self._keys[0].shape[3]
+
+    def reset(self, rows=None):
+        self.length = 0
+        self.rows = self.batch_size if rows is None else rows
+
+    def advance(self, seq_len, len_past=None):
+        super(StaticKVCache, self).advance(seq_len, len_past=len_past)
+        assert self.length <= self.max_len, f'The KV cache holds at most {self.max_len} positions'
+
+    def reorder_(self, beam_idx: Tensor):
+        rows = beam_idx.shape[0]
+        torch.index_select(self.key, 0, beam_idx, out=self._keys[1][:rows])
+        torch.index_select(self.value, 0, beam_idx, out=self._values[1][:rows])
+        self._keys.reverse()
+        self._values.reverse()
+        self.rows = rows
+        return self
+
+    def write_row_(self, row, presents):
+        # Copy the presents of a forward pass without cache, for a single sequence, into a row,
+        # and clear the rest of the row left by its previous sequence
+        length = presents[0].shape[-2]
+        for layer, present in enumerate(presents):
+            self._keys[0][row, layer, :, :length] = present[0, 0]
+            self._values[0][row, layer, :, :length] = present[1, 0]
+        self._keys[0][row, :, :, length:] = 0
+        self._values[0][row, :, :, length:] = 0
+        self.rows = max(self.rows, row + 1)
+
+    def move_row_(self, src, dst, length):
+        # Move the first length positions of row src into row dst, clearing the rest of dst
+        self._keys[0][dst, :, :, :length] = self._keys[0][src, :, :, :length]
+        self._values[0][dst, :, :, :length] = self._values[0][src, :, :, :length]
+        self._keys[0][dst, :, :, length:] = 0
+        self._values[0][dst, :, :, length:] = 0
+
+
+class StaticLayerKVCache(LayerKVCache):
+    def update(self, key: Tensor, value: Tensor, len_past: Tensor = None):
+        # Returns views of the cache
+        cache, length = self.cache, self.cache.length
+        past_key, past_value = cache.key[:, self.layer], cache.value[:, self.layer]
+        if len_past is None:
+            past_key[:, :, length - key.shape[-2]:length] = key
+            past_value[:, :, length - value.shape[-2]:length] = value
+        else:
+            assert key.shape[-2] == 1
+            _batch = torch.arange(0, key.shape[0], dtype=torch.long, device=key.device)
+            past_key[_batch, :, len_past, :] = key.squeeze(-2)
+            past_value[_batch, :, len_past, :] = value.squeeze(-2)
+        return past_key[:, :, :length], past_value[:, :, :length]
+
+
+class PagedKVCache(KVCache):
+    # Keys and values stored in blocks of block_size positions, (n_layer, num_blocks, head, block_size,
+    # head_features), that every row of the batch refers to through its row of block_table. Rows forked
+    # from the same prompt share its blocks, and a block referred to more than once is copied before it
+    # is written to. Full blocks of prompts are kept in a prefix cache, so that later prompts starting
+    # with the same tokens reuse them; the least recently used ones are evicted when blocks run out.
+    def __init__(self, n_layer, num_blocks, block_size, n_head, head_features, dtype=None, device=None):
+        shape = (n_layer, num_blocks, n_head, block_size, head_features)
+        # Zeros, as masked positions of blocks not written to still enter attention with weight 0
+        self.key = torch.zeros(shape, dtype=dtype, device=device)
+        self.value = torch.zeros(shape, dtype=dtype, device=device)
+        self.block_size = block_size
+        # Kept on the CPU, only the block indices used by a forward pass are copied to the device
+        self.block_table = torch.full((0, 0), -1, dtype=torch.long)
+        self.refcount = torch.zeros(num_blocks, dtype=torch.long)
+        # Tokens from the start of a prompt to the end of a block -> that block, valid for the weights
+        # identified by weights_version
+        self.prefix_blocks = OrderedDict()
+        self.weights_version = None
+        self._blocks = None
+        self._write_blocks = None
+        self._write_offsets = None
+        super(PagedKVCache, self).__init__(n_layer, PagedLayerKVCache)
+
+    @property
+    def num_blocks(self):
+        return self.key.shape[1]
+
+    def _update_refcount(self):
+        table = self.block_table
+        self.refcount = torch.bincount(table[table >= 0], minlength=self.num_blocks)
+        for block in self.prefix_blocks.values():
+            self.refcount[block] += 1
+
+    def _evict(self, prefix):
+        # Drop prefix with all its longer extensions, which match_prefix() could no longer reach
+        for k in [k for k in self.prefix_blocks if k[:len(prefix)] == prefix]:
+            self.refcount[self.prefix_blocks.pop(k)] -= 1
+
+    def _allocate(self, n):
+        free = (self.refcount == 0).nonzero().view(-1)
+        while free.numel() < n and self.prefix_blocks:
+            self._evict(next(iter(self.prefix_blocks)))
+            free = (self.refcount == 0).nonzero().view(-1)
+        assert free.numel() >= n, f'The KV cache ran out of its {self.num_blocks} blocks'
+        self.refcount[free[:n]] = 1
+        return free[:n].tolist()
+
+    def start(self, batch_size):
+        # Start a batch of batch_size empty rows, keeping the prefix cache
+        self.block_table = torch.full((batch_size, 0), -1, dtype=torch.long)
+        self.length = 0
+        self._update_refcount()
+
+    def reset(self):
+        self.prefix_blocks.clear()
+        self.start(0)
+
+    def set_weights_version(self, version):
+        # Clear the prefix cache when the weights or adapters it was computed with changed
+        if version != self.weights_version:
+            self.weights_version = version
+            self.reset()
+
+    def match_prefix(self, query: Tensor, query_len: Tensor):
+        # Point the rows at the cached blocks of the longest prefix of full blocks that all the queries
+        # have in the cache, keeping at least the last token of every query to compute its logits.
+        # Returns the number of positions found, from which the queries are fed to the model.
+        bs = self.block_size
+        tokens, query_len = query.tolist(), query_len.tolist()
+        matched = []
+        for row, _len in zip(tokens, query_len):
+            blocks = []
+            while (len(blocks) + 1) * bs <= _len - 1:
+                block = self.prefix_blocks.get(tuple(row[:(len(blocks) + 1) * bs]))
+                if block is None:
+                    break
+                blocks.append(block)
+            matched.append(blocks)
+        n = min(len(blocks) for blocks in matched) if matched else 0
+        if n > 0:
+            self.block_table = torch.tensor([blocks[:n] for blocks in matched], dtype=torch.long)
+            for row in tokens:
+                for k in range(1, n + 1):
+                    self.prefix_blocks.move_to_end(tuple(row[:k * bs]))
+            self._update_refcount()
+        self.length = n * bs
+        return self.length
+
+    def register_prefix(self, query: Tensor, query_len: Tensor):
+        # Add the full blocks of the queries, once they went through the model, to the prefix cache
+        bs = self.block_size
+        for i, (row, _len) in enumerate(zip(query.tolist(), query_len.tolist())):
+            for k in range(_len // bs):
+                prefix = tuple(row[:(k + 1) * bs])
+                if prefix not in self.prefix_blocks:
+                    block = int(self.block_table[i, k])
+                    self.prefix_blocks[prefix] = block
+                    self.refcount[block] += 1
+
+    def fork(self, num_beams):
+        # Repeat every row num_beams times, the copies sharing the blocks of the row
+        self.block_table = self.block_table.repeat_interleave(num_beams, dim=0)
+        self._update_refcount()
+
+    def reorder_(self, beam_idx: Tensor):
+        # Only the block table is reordered; the blocks of dropped beams are freed
+        self.block_table = self.block_table[beam_idx.cpu()]
+        self._update_refcount()
+        return self
+
+    def advance(self, seq_len, len_past=None):
+        bs, batch_size = self.block_size, self.block_table.shape[0]
+        if len_past is None:
+            positions = torch.arange(self.length, self.length + seq_len).unsqueeze(0).expand(batch_size, -1)
+        else:
+            positions = len_past.cpu().unsqueeze(1)
+        super(PagedKVCache, self).advance(seq_len, len_past=len_past)
+
+        n_blocks = (self.length + bs - 1) // bs
+        if self.block_table.shape[1] < n_blocks:
+            self.block_table = torch.cat([
+                self.block_table,
+                self.block_table.new_full((batch_size, n_blocks - self.block_table.shape[1]), -1)
+            ], dim=1)
+
+        # Allocate the blocks written to for the first time, and copy the shared ones
+        table = self.block_table
+        rows, cols = torch.unique(torch.stack([
+            torch.arange(batch_size).unsqueeze(1).expand_as(positions), positions // bs
+        ]).view(2, -1), dim=1)
+        new_blocks = []
+        for row, col in zip(rows.tolist(), cols.tolist()):
+            block = int(table[row, col])
+            if block < 0:
+                table[row, col] = self._allocate(1)[0]
+            elif self.refcount[block] > 1:
+                self.refcount[block] -= 1
+                table[row, col] = self._allocate(1)[0]
+                new_blocks.append((block, int(table[row, col])))
+        if new_blocks:
+            old, new = torch.tensor(new_blocks, device=self.key.device).unbind(1)
+            self.key[:, new] = self.key[:, old]
+            self.value[:, new] = self.value[:, old]
+
+        device = self.key.device
+        # Blocks not allocated yet only hold positions that are masked out
+        self._blocks = table[:, :n_blocks].clamp(min=0).to(device)
+        self._write_blocks = table.gather(1, positions // bs).to(device)
+        self._write_offsets = (positions % bs).to(device)
+
+
+class PagedLayerKVCache(LayerKVCache):
+    def update(self, key: Tensor, value: Tensor, len_past: Tensor = None):
+        # Writes the new positions into their blocks, then gathers the blocks of every row
+        cache = self.cache
+        key_blocks, value_blocks = cache.key[self.layer], cache.value[self.layer]
+        key_blocks[cache._write_blocks, :, cache._write_offsets] = key.transpose(1, 2)
+        value_blocks[cache._write_blocks, :, cache._write_offsets] = value.transpose(1, 2)
+
+        def gather(blocks):
+            # batch, n_blocks, head, block_size, head_features -> batch, head, length, head_features
+            x = blocks[cache._blocks].transpose(1, 2)
+            return x.reshape(*x.shape[:2], -1, x.shape[-1])[:, :, :cache.length]
+
+        return gather(key_blocks), gather(value_blocks)
@@ -13,12 +13,15 @@ import torch
 from torch import nn
 from torch.nn import CrossEntropyLoss, MSELoss
 import torch.nn.functional as F
+import torch.utils.checkpoint
 from torch.optim import Optimizer
 from torch.optim.lr_scheduler import LambdaLR
 from torch.nn.parameter import Parameter
 
 import loralib as lora
 
+from kv_cache import KVCache, LayerKVCache, StaticKVCache, PagedKVCache
+
 
 def gelu(x):
     return 0.5 * x * (1 + torch.tanh(math.sqrt(2 / math.pi) * (x + 0.044715 * torch.pow(x, 3))))
@@ -87,7 +90,7 @@ class Attention(nn.Module):
         # [switch nx => n_state from Block to Attention to keep identical to TF implem]
         
         assert n_state % config.n_head == 0
-        self.register_buffer("bias", torch.tril(torch.ones(n_ctx, n_ctx)).view(1, 1, n_ctx, n_ctx))
+        self.register_buffer("bias", self.causal_mask(n_ctx))
         self.n_head = config.n_head
         self.split_size = n_state
         self.scale = scale
@@ -104,6 +107,10 @@ class Attention(nn.Module):
 
         self.config = config
     
+    @staticmethod
+    def causal_mask(n_ctx, device=None):
+        return torch.tril(torch.ones(n_ctx, n_ctx, device=device)).view(1, 1, n_ctx, n_ctx)
+
     def _attn(self, q, k, v, len_kv=None):
         w = torch.matmul(q, k)
         if self.scale:
@@ -124,6 +131,40 @@ class Attention(nn.Module):
         w = nn.Softmax(dim=-1)(w)
         return torch.matmul(w, v)
 
+    def _attn_mask(self, nd, ns, len_kv, start=0, end=None):
+        # Causal mask of the queries [start, end) of nd against ns keys, True where attention is allowed
+        end = nd if end is None else end
+        b = self.bias[:, :, ns-nd+start:ns-nd+end, :ns].bool()
+        if len_kv is not None:
+            _len = torch.arange(ns, device=b.device)
+            b = b & (_len[None, :] < len_kv[:, None]).unsqueeze(1).unsqueeze(2)
+        return b
+
+    def _fused_attn(self, q, k, v, len_kv=None):
+        # q, k, v : (batch, head, seq_length, head_features)
+        nd, ns = q.size(-2), k.size(-2)
+        if not self.scale:
+            # Undo the 1/sqrt(head_features) applied by the fused kernels
+            q = q * math.sqrt(v.size(-1))
+        if hasattr(F, 'scaled_dot_product_attention'):
+            if len_kv is None and nd == ns:
+                return F.scaled_dot_product_attention(q, k, v, is_causal=True)
+            elif len_kv is None and nd == 1:
+                return F.scaled_dot_product_attention(q, k, v)
+            # is_causal aligns the mask to the first key, the cache needs it aligned to the last one
+            return F.scaled_dot_product_attention(q, k, v, attn_mask=self._attn_mask(nd, ns, len_kv))
+
+        # Fall back to attention over chunks of queries, which bounds the size of the attention weights
+        k = k.transpose(-2, -1) / math.sqrt(v.size(-1))
+        chunk = self.config.attn_chunk_size
+        out = []
+        for start in range(0, nd, chunk):
+            end = min(start + chunk, nd)
+            w = torch.matmul(q[:, :, start:end], k)
+            w = w.masked_fill_(~self._attn_mask(nd, ns, len_kv, start, end), -1.0e10)
+            out.append(torch.matmul(w.softmax(dim=-1), v))
+        return torch.cat(out, dim=-2) if len(out) > 1 else out[0]
+
     def merge_heads(self, x):
         x = x.permute(0, 2, 1, 3).contiguous()
         new_x_shape = x.size()[:-2] + (x.size(-2) * x.size(-1),)
@@ -144,14 +185,25 @@ class Attention(nn.Module):
         query, key, value = x.split(self.split_size, dim=2)
 
         query = self.split_heads(query)
-        key = self.split_heads(key, k=True)
+        if self.config.fused_attn:
+            # The key layout of split_heads(key, k=True), as a view instead of a contiguous copy
+            key = self.split_heads(key).transpose(-2, -1)
+        else:
+            key = self.split_heads(key, k=True)
         value = self.split_heads(value)
 
         #_input_msk = None
 
         len_kv = None
 
-        if layer_past is not None:
+        if isinstance(layer_past, LayerKVCache):
+            # Write in place into the preallocated cache, which is also the present of the layer
+            key, value = layer_past.update(key.transpose(-2, -1), value, len_past=len_past)
+            key = key.transpose(-2, -1)
+            if len_past is not None:
+                len_kv = len_past + 1
+            present = layer_past
+        elif layer_past is not None:
             # key : (batch, head, head_features, seq_length)
             # value : (batch, head, seq_length, head_features)
             # layer_past, key : (batch, head, seq_length, head_features)
@@ -175,8 +227,12 @@ class Attention(nn.Module):
 
                 len_kv = len_past + 1
 
-        present = torch.stack((key.transpose(-2, -1), value))  # transpose to have same shapes for stacking
-        a = self._attn(query, key, value, len_kv = len_kv)
+        if not isinstance(layer_past, LayerKVCache):
+            present = torch.stack((key.transpose(-2, -1), value))  # transpose to have same shapes for stacking
+        if self.config.fused_attn:
+            a = self._fused_attn(query, key.transpose(-2, -1), value, len_kv = len_kv)
+        else:
+            a = self._attn(query, key, value, len_kv = len_kv)
         a = self.merge_heads(a)
         a = self.c_proj(a)
         return a, present
@@ -227,7 +283,66 @@ class GPT2Model(nn.Module):
         self.ln_f = LayerNorm(config.n_embd, eps=config.layer_norm_epsilon)
 
         self.config = config
-
+        self.kv_cache = None
+
+    def allocate_kv_cache(self, batch_size, max_len, dtype=None, device=None):
+        # A StaticKVCache for batch_size rows of up to max_len positions, to pass as past. The model
+        # keeps it and hands it out again, emptied, as long as it is large enough, e.g. for a last
+        # batch with fewer rows.
+        dtype = dtype or self.wte.weight.dtype
+        device = device or self.wte.weight.device
+        cache = self.kv_cache
+        if not isinstance(cache, StaticKVCache) or cache.batch_size < batch_size or cache.max_len < max_len or \
+            cache.key.dtype != dtype or cache.key.device != torch.device(device):
+            self.kv_cache = None
+            cache = StaticKVCache(
+                self.n_layer, batch_size, self.config.n_head, max_len, self.n_embd // self.config.n_head,
+                dtype=dtype, device=device
+            )
+            self.kv_cache = cache
+        cache.reset(batch_size)
+        return cache
+
+    def allocate_paged_kv_cache(self, num_blocks, block_size=16, dtype=None, device=None):
+        # A PagedKVCache to pass as past. The model keeps it, with its prefix cache, across batches.
+        dtype = dtype or self.wte.weight.dtype
+        device = device or self.wte.weight.device
+        cache = self.kv_cache
+        if not isinstance(cache, PagedKVCache) or cache.num_blocks != num_blocks or \
+            cache.block_size != block_size or cache.key.dtype != dtype or cache.key.device != torch.device(device):
+            self.kv_cache = None
+            cache = PagedKVCache(
+                self.n_layer, num_blocks, block_size, self.config.n_head, self.n_embd // self.config.n_head,
+                dtype=dtype, device=device
+            )
+            self.kv_cache = cache
+        cache.set_weights_version(self.weights_version())
+        return cache
+
+    def weights_version(self):
+        # Changes when a parameter or buffer (e.g. an adapter bank) is replaced or updated in place,
+        # or when the adapters selected per row change
+        tensors = list(self.parameters()) + list(self.buffers()) + [
+            m.adapter_index for m in self.modules() if getattr(m, 'adapter_index', None) is not None
+        ]
+        return tuple((id(t), t.data_ptr(), t._version) for t in tensors)
+
+    def checkpointed_blocks(self, batch_size, seq_len, hidden_states):
+        # Blocks to run with activation checkpointing, every checkpoint_every-th block, or as few as
+        # needed to keep the activations of the other blocks within checkpoint_budget MB
+        if self.config.checkpoint_every > 0:
+            return set(range(0, len(self.h), self.config.checkpoint_every))
+        elif self.config.checkpoint_budget > 0:
+            # Activations kept by a block for backward: about 34 values per hidden unit and token,
+            # and 5 per head and pair of tokens for the attention (Korthikanti et al., 2022)
+            block_bytes = batch_size * seq_len * (34 * self.n_embd + 5 * self.config.n_head * seq_len) * \
+                hidden_states.element_size() / 2
+            kept = int(self.config.checkpoint_budget * 2**20 // block_bytes)
+            return set(range(max(len(self.h) - kept, 0)))
+        return set()
+
+    def release_kv_cache(self):
+        self.kv_cache = None
 
     def forward(
         self, 
@@ -240,6 +355,9 @@ class GPT2Model(nn.Module):
         if past is None:
             past_length = 0
             past = [None] * len(self.h)
+        elif isinstance(past, KVCache):
+            past_length = past.length
+            past.advance(input_ids.size(-1), len_past=len_past)
         elif len_past is None:
             # equal size for past. []
             past_length = past[0][0].size(-2)
@@ -268,14 +386,34 @@ class GPT2Model(nn.Module):
             token_type_embeds = 0
         hidden_states = inputs_embeds + position_embeds + token_type_embeds
         presents = []
-        for block, layer_past in zip(self.h, past):
-            hidden_states, present = block(hidden_states, layer_past = layer_past, len_past=len_past)
+        checkpointed = set()
+        if self.training and torch.is_grad_enabled() and not isinstance(past, KVCache) and past[0] is None:
+            checkpointed = self.checkpointed_blocks(input_ids.size(0), input_ids.size(-1), hidden_states)
+        for i, (block, layer_past) in enumerate(zip(self.h, past)):
+            if i in checkpointed:
+                # Non-reentrant, so that the LoRA parameters of the block get their gradients even when
+                # hidden_states does not require grad, e.g. with frozen embeddings
+                hidden_states, present = torch.utils.checkpoint.checkpoint(block, hidden_states, use_reentrant=False)
+            else:
+                hidden_states, present = block(hidden_states, layer_past = layer_past, len_past=len_past)
             presents.append(present)
+        if isinstance(past, KVCache):
+            presents = past
         hidden_states = self.ln_f(hidden_states)
         output_shape = input_shape + (hidden_states.size(-1),)
         return hidden_states.view(*output_shape), presents
 
 
+def load_checkpoint(path, map_location='cpu'):
+    # torch.load with mmap=True where supported, so that the tensors are read from the file
+    # when first used instead of being copied into memory up front
+    try:
+        return torch.load(path, map_location=map_location, mmap=True)
+    except (TypeError, RuntimeError):
+        # PyTorch < 2.1, or a checkpoint in the legacy format
+        return torch.load(path, map_location=map_location)
+
+
 class GPT2LMHead(nn.Module):
     def __init__(self, model_embeddings_weights, config):
         super(GPT2LMHead, self).__init__()
@@ -283,8 +421,14 @@ class GPT2LMHead(nn.Module):
         self.set_embeddings_weights(model_embeddings_weights)
 
     def set_embeddings_weights(self, model_embeddings_weights):
-        embed_shape = model_embeddings_weights.shape
-        self.decoder = nn.Linear(embed_shape[1], embed_shape[0], bias=False)
+        if not hasattr(self, 'decoder'):
+            embed_shape = model_embeddings_weights.shape
+            try:
+                # Its weight is replaced right away, so it is not allocated nor initialized
+                self.decoder = nn.Linear(embed_shape[1], embed_shape[0], bias=False, device='meta')
+            except TypeError:
+                # PyTorch < 1.9
+                self.decoder = nn.Linear(embed_shape[1], embed_shape[0], bias=False)
         self.decoder.weight = model_embeddings_weights  # Tied weights
 
     def forward(self, hidden_state):
@@ -310,6 +454,10 @@ class GPT2Config(object):
         lora_dropout=0.0,
         lora_r_dropout=0.0,
         fix_dropout=0.0,
+        fused_attn=False,
+        attn_chunk_size=512,
+        checkpoint_every=0,
+        checkpoint_budget=0,
     ):
         self.vocab_size = vocab_size_or_config_json_file
         self.n_ctx = n_ctx
@@ -325,6 +473,14 @@ class GPT2Config(object):
         self.lora_r_dropout = lora_r_dropout
 
         self.fix_dropout = fix_dropout
+        # Attention with F.scaled_dot_product_attention, or over chunks of attn_chunk_size queries
+        # on versions of PyTorch without it
+        self.fused_attn = fused_attn
+        self.attn_chunk_size = attn_chunk_size
+        # Activation checkpointing of every checkpoint_every-th block during training,
+        # or of enough blocks to keep the activations within checkpoint_budget MB
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_budget = checkpoint_budget
 
 
 class GPT2LMModel(nn.Module):
@@ -346,42 +502,32 @@ class GPT2LMModel(nn.Module):
         past=None, 
         len_past=None, 
         label_smooth=0.0,
-        is_report_accuracy=False
+        is_report_accuracy=False,
+        loss_chunk_size=0
     ):
         _batch, _len = input_ids.shape
         hidden_states, presents = self.transformer(input_ids, past=past, len_past=len_past)
 
+        if lm_labels is not None and loss_chunk_size > 0 and not is_report_accuracy:
+            # Only the loss is computed, the logits are not returned
+            return None, self.chunked_lm_loss(hidden_states, lm_labels, lm_mask, label_smooth, loss_chunk_size)
+
         # batch, seq, vocab
         lm_logits = self.lm_head(hidden_states)
 
         if lm_labels is not None:
 
             if is_report_accuracy:
+                # _t1_acc: the first target token is predicted, _all_acc: all target tokens are predicted,
+                # _tok_acc: fraction of target tokens predicted, for every row of the batch
                 _pred_token = torch.argmax(lm_logits, dim=-1)
-                _hit = (_pred_token == lm_labels) * lm_mask
-
-                _t1_acc = torch.zeros(_batch, dtype=torch.float, device=input_ids.device)
-                _all_acc = torch.zeros(_batch, dtype=torch.float, device=input_ids.device)
-                
-                for _b in range(0, _batch):
-                    for _i in range(0, _len):
-                        if lm_mask[_b, _i] >= 1.0:
-                            if _hit[_b, _i] > 0:
-                                _t1_acc[_b] = 1.0
-                            break  
-
-                    _is_succ = True
-                    for _i in range(0, _len):
-                        if lm_mask[_b, _i] >= 1.0:
-                            if _hit[_b, _i] <= 0:
-                                _is_succ = False
-                                break
-
-                    if _is_succ:
-                        _all_acc[_b] = 1.0
-
-                #_t1_acc = _t1_acc * 1.0 / _batch
-                #_all_acc = _all_acc * 1.0 / _batch
+                _valid = lm_mask >= 1.0
+                _hit = (_pred_token == lm_labels) & _valid
+
+                _first = _valid.int().argmax(dim=-1)
+                _t1_acc = (_hit.gather(1, _first.unsqueeze(1)).squeeze(1) & _valid.any(dim=-1)).float()
+                _all_acc = (_hit | ~_valid).all(dim=-1).float()
+                _tok_acc = _hit.sum(dim=-1).float() / _valid.sum(dim=-1).clamp(min=1).float()
 
             if label_smooth > 0.0001:
                 logprobs = torch.nn.functional.log_softmax(lm_logits.view(-1, lm_logits.size(-1)), dim=-1)
@@ -401,11 +547,43 @@ class GPT2LMModel(nn.Module):
             loss = loss.sum() / (lm_mask.sum() + 0.0001)
 
             if is_report_accuracy:
-                return lm_logits, loss, _t1_acc, _all_acc
+                return lm_logits, loss, _t1_acc, _all_acc, _tok_acc
             else:
                 return lm_logits, loss
         return lm_logits, presents
            
+    def _lm_loss_chunk(self, hidden_states, lm_labels, weights, label_smooth):
+        logprobs = torch.nn.functional.log_softmax(self.lm_head(hidden_states), dim=-1)
+        nll_loss = -logprobs.gather(dim=-1, index=lm_labels.clamp(min=0).unsqueeze(1)).squeeze(1)
+        if label_smooth > 0.0001:
+            smooth_loss = -logprobs.mean(dim=-1)
+            loss = (1.0 - label_smooth) * nll_loss + label_smooth * smooth_loss
+        else:
+            # ignore_index=-1
+            loss = nll_loss * (lm_labels != -1).to(nll_loss.dtype)
+        return (loss * weights).sum()
+
+    def chunked_lm_loss(self, hidden_states, lm_labels, lm_mask=None, label_smooth=0.0, chunk_size=1024):
+        # The loss of forward(), computed only at the positions where lm_mask is nonzero, chunk_size
+        # positions at a time. The logits of a chunk are recomputed in backward rather than kept,
+        # so that at most one chunk of (chunk_size, vocab) logits is alive.
+        hidden_states = hidden_states.reshape(-1, hidden_states.size(-1))
+        lm_labels = lm_labels.reshape(-1)
+        if lm_mask is None:
+            lm_mask = torch.ones(lm_labels.shape, dtype=hidden_states.dtype, device=hidden_states.device)
+        lm_mask = lm_mask.reshape(-1)
+
+        _pos = lm_mask.nonzero().squeeze(1)
+        loss = hidden_states.new_zeros(())
+        for start in range(0, _pos.size(0), chunk_size):
+            _chunk = _pos[start:start + chunk_size]
+            _inputs = (hidden_states[_chunk], lm_labels[_chunk], lm_mask[_chunk].to(hidden_states.dtype), label_smooth)
+            if torch.is_grad_enabled() and (hidden_states.requires_grad or self.lm_head.decoder.weight.requires_grad):
+                loss = loss + torch.utils.checkpoint.checkpoint(self._lm_loss_chunk, *_inputs, use_reentrant=False)
+            else:
+                loss = loss + self._lm_loss_chunk(*_inputs)
+        return loss / (lm_mask.sum() + 0.0001)
+
     def _init_weights(self, module):
         if isinstance(module, (nn.Linear, nn.Embedding)):
             module.weight.data.normal_(mean=0.0, std=0.02)
@@ -415,35 +593,77 @@ class GPT2LMModel(nn.Module):
         if isinstance(module, nn.Linear) and module.bias is not None:
             module.bias.data.zero_()
 
-    def load_weight(self, state_dict):
+    @staticmethod
+    def _rename_key(key):
+        new_key = key
+        if key.endswith(".g"):
+            new_key = key[:-2] + ".weight"
+        elif key.endswith(".b"):
+            new_key = key[:-2] + ".bias"
+        elif key.endswith(".w"):
+            new_key = key[:-2] + ".weight"
+        
+        if key.startswith("module.transformer."):
+            new_key = key[len("module.transformer."):]
+        return new_key
+
+    def load_weight(self, state_dict, device=None):
         if 'model_state_dict' in state_dict:
             state_dict = state_dict['model_state_dict']
-    
-        state_dict_tmp = copy.deepcopy(state_dict)
-        old_keys = []
-        new_keys = []
-        for key in state_dict_tmp:
-            new_key = None
-            if key.endswith(".g"):
-                new_key = key[:-2] + ".weight"
-            elif key.endswith(".b"):
-                new_key = key[:-2] + ".bias"
-            elif key.endswith(".w"):
-                new_key = key[:-2] + ".weight"
-            
-            if key.startswith("module.transformer."):
-                new_key = key[len("module.transformer."):]
-
-            if new_key:
-                old_keys.append(key)
-                new_keys.append(new_key)
-
-        for old_key, new_key in zip(old_keys, new_keys):
-            state_dict[new_key] = state_dict.pop(old_key)
-        
-        for n, p in self.transformer.named_parameters():
-            if n not in state_dict:
-                state_dict[n] = p
 
-        self.transformer.load_state_dict(state_dict, strict=False)
+        # A new dict with the renamed keys, referring to the same tensors, which also leaves
+        # the state_dict of the caller untouched
+        state_dict = {self._rename_key(k): v for k, v in state_dict.items()}
+
+        # LoRA checkpoints pruned with lora.prune_lora_rank have a rank per layer
+        lora.set_lora_ranks(self.transformer, lora.lora_rank_map(state_dict))
+
+        if any(p.is_meta for p in self.transformer.parameters()):
+            self._materialize(state_dict, device)
+        else:
+            self.transformer.load_state_dict(state_dict, strict=False)
         self.set_tied()
+
+    def _materialize(self, state_dict, device=None):
+        # Replace the meta tensors of a model built by from_pretrained() with the tensors of state_dict,
+        # moved to device only if needed. LoRA parameters missing from state_dict are initialized.
+        device = torch.device(device) if device is not None else torch.device('cpu')
+        for n, m in self.transformer.named_modules():
+            prefix = n + '.' if n else ''
+            for k, p in m._parameters.items():
+                if p is None or not p.is_meta:
+                    continue
+                if prefix + k in state_dict:
+                    t = state_dict[prefix + k].to(device=device, dtype=p.dtype)
+                else:
+                    assert k in ['lora_A', 'lora_B'], f'{prefix + k} is missing from the checkpoint'
+                    t = torch.empty(p.shape, dtype=p.dtype, device=device)
+                m._parameters[k] = nn.Parameter(t, requires_grad=p.requires_grad)
+            if isinstance(m, (lora.Linear, lora.MergedLinear)) and hasattr(m, 'lora_A') and \
+                prefix + 'lora_A' not in state_dict:
+                nn.init.kaiming_uniform_(m.lora_A, a=math.sqrt(5))
+                nn.init.zeros_(m.lora_B)
+            if isinstance(m, lora.MergedLinear) and hasattr(m, 'lora_ind'):
+                m.lora_ind = torch.tensor(m.enable_lora, device=device).repeat_interleave(
+                    m.out_features // len(m.enable_lora)
+                )
+            if isinstance(m, Attention) and m.bias.is_meta:
+                m.register_buffer("bias", m.causal_mask(m.bias.size(-1), device=device))
+            for k, b in m._buffers.items():
+                if b is not None and b.is_meta:
+                    assert prefix + k in state_dict, f'{prefix + k} is missing from the checkpoint'
+                    m._buffers[k] = state_dict[prefix + k].to(device=device, dtype=b.dtype)
+
+    @classmethod
+    def from_pretrained(cls, config, state_dict, device=None):
+        # Build the model on the meta device, which skips the random initialization of the weights,
+        # and use the tensors of state_dict as its parameters, e.g. the memory-mapped tensors
+        # of load_checkpoint(). Requires PyTorch >= 2.0, falls back to a regular load otherwise.
+        if not hasattr(torch.device, '__enter__'):
+            model = cls(config).to(device)
+            model.load_weight(state_dict)
+            return model
+        with torch.device('meta'):
+            model = cls(config)
+        model.load_weight(state_dict, device=device)
+        return model
@@ -1,4 +1,7 @@
 name = "lora"
 
 from .layers import *
-from .utils import *
\ No newline at end of file
+from .utils import *
+from .checkpoint import *
+from .rank import *
+from .surgery import *
\ No newline at end of file
@@ -0,0 +1,146 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import json
+import mmap
+import struct
+from collections.abc import Mapping
+
+import torch
+import torch.nn as nn
+
+from typing import Dict, Iterator, Union
+
+from .layers import LoRALayer
+
+
+# A LoRA checkpoint is laid out as
+#   8 bytes    little-endian length of the header
+#   header     JSON {name: {"dtype": ..., "shape": [...], "offset": ...}}, padded with spaces
+#   data       raw tensor bytes, each tensor starting at a multiple of LORA_ALIGNMENT
+# Offsets are relative to the start of the data, which is itself aligned.
+LORA_ALIGNMENT = 64
+
+_INT_VIEWS = {1: torch.uint8, 2: torch.int16, 4: torch.int32, 8: torch.int64}
+
+
+def _align(n: int) -> int:
+    return (n + LORA_ALIGNMENT - 1) // LORA_ALIGNMENT * LORA_ALIGNMENT
+
+
+def save_lora_checkpoint(state_dict: Dict[str, torch.Tensor], path: str) -> None:
+    tensors = {k: t.detach().cpu().contiguous() for k, t in state_dict.items()}
+    header, offset = {}, 0
+    for k, t in tensors.items():
+        header[k] = {
+            'dtype': str(t.dtype).split('.')[-1],
+            'shape': list(t.shape),
+            'offset': offset
+        }
+        offset = _align(offset + t.numel() * t.element_size())
+    header = json.dumps(header).encode('utf-8')
+    header += b' ' * (_align(8 + len(header)) - 8 - len(header))
+    with open(path, 'wb') as writer:
+        writer.write(struct.pack('<Q', len(header)))
+        writer.write(header)
+        for k, t in tensors.items():
+            data = t.view(_INT_VIEWS[t.element_size()]).numpy().tobytes() if t.numel() > 0 else b''
+            writer.write(data)
+            writer.write(b'\0' * (_align(len(data)) - len(data)))
+
+
+class LoRACheckpoint(Mapping):
+    # Read-only mapping over a memory-mapped LoRA checkpoint. Tensors are views into the
+    # mapping, so reading an adapter that is already in the page cache does not touch the disk,
+    # and pages are only copied if a tensor is written to.
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as reader:
+            header_len = struct.unpack('<Q', reader.read(8))[0]
+            self.header = json.loads(reader.read(header_len).decode('utf-8'))
+            self._mmap = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_COPY)
+        self._data_start = 8 + header_len
+
+    def __getitem__(self, key: str) -> torch.Tensor:
+        info = self.header[key]
+        dtype = getattr(torch, info['dtype'])
+        numel = 1
+        for d in info['shape']:
+            numel *= d
+        if numel == 0:
+            return torch.empty(info['shape'], dtype=dtype)
+        return torch.frombuffer(
+            self._mmap, dtype=dtype, count=numel, offset=self._data_start + info['offset']
+        ).view(info['shape'])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.header)
+
+    def __len__(self) -> int:
+        return len(self.header)
+
+
+def load_lora_checkpoint(path: str) -> LoRACheckpoint:
+    return LoRACheckpoint(path)
+
+
+def convert_pt_to_lora_checkpoint(pt_path: str, path: str) -> None:
+    state_dict = torch.load(pt_path, map_location=torch.device('cpu'))
+    # Checkpoints saved by the GPT-2 example wrap the state_dict
+    if 'model_state_dict' in state_dict:
+        state_dict = state_dict['model_state_dict']
+    save_lora_checkpoint(state_dict, path)
+
+
+def convert_lora_checkpoint_to_pt(path: str, pt_path: str) -> None:
+    checkpoint = load_lora_checkpoint(path)
+    torch.save({k: checkpoint[k].clone() for k in checkpoint}, pt_path)
+
+
+def _copy_into(param: nn.Parameter, t: torch.Tensor) -> None:
+    # Always copy: a parameter sharing the mapped pages would write into the checkpoint on every
+    # in-place update (optimizer step, swap_lora_) and be shared by all models attached to it
+    with torch.no_grad():
+        param.copy_(t)
+
+
+def attach_lora_checkpoint(
+    model: nn.Module,
+    checkpoint: Union[str, LoRACheckpoint],
+    lazy: bool = True
+) -> None:
+    # Loads the LoRA tensors of the checkpoint into the LoRA layers of the model. With lazy=True,
+    # a layer only reads its tensors right before its first forward pass.
+    if isinstance(checkpoint, str):
+        checkpoint = load_lora_checkpoint(checkpoint)
+    for n, m in model.named_modules():
+        if not isinstance(m, LoRALayer):
+            continue
+        prefix = n + '.' if n else ''
+        names = [k for k, _ in m.named_parameters(recurse=False) if prefix + k in checkpoint]
+        if not names:
+            continue
+
+        def load(module, *args, prefix=prefix, names=names):
+            # A merged layer is unmerged with its old weights and merged again with the new ones
+            merged, training = module.merged, module.training
+            if merged:
+                module.train(True)
+            params = dict(module.named_parameters(recurse=False))
+            for k in names:
+                _copy_into(params[k], checkpoint[prefix + k])
+            module.clear_weight_cache()
+            if merged:
+                module.train(training)
+            if getattr(module, '_lora_attach_hook', None) is not None:
+                module._lora_attach_hook.remove()
+                module._lora_attach_hook = None
+
+        if getattr(m, '_lora_attach_hook', None) is not None:
+            m._lora_attach_hook.remove()
+        if lazy:
+            m._lora_attach_hook = m.register_forward_pre_hook(load)
+        else:
+            m._lora_attach_hook = None
+            load(m)
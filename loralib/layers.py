@@ -6,9 +6,84 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+import functools
 import math
+import operator
 from typing import Optional, List
 
+
+def quantize_per_channel(w: torch.Tensor, bits: int = 8):
+    # Symmetric per-output-channel quantization of a (out_features, in_features) weight.
+    # Returns int8 values, or two 4-bit values packed per uint8 along in_features, and the scales.
+    assert bits in [8, 4], 'Only 8-bit and 4-bit weights are supported'
+    q_max = 2 ** (bits - 1) - 1
+    w = w.detach().float()
+    scale = (w.abs().amax(dim=1) / q_max).clamp(min=1e-12)
+    q = torch.round(w / scale.unsqueeze(1)).clamp(-q_max, q_max).to(torch.int8)
+    if bits == 4:
+        q = (F.pad(q, (0, q.shape[1] % 2)) + 8).to(torch.uint8)
+        q = q[:, 0::2] | (q[:, 1::2] << 4)
+    return q, scale
+
+
+def dequantize_per_channel(
+    q: torch.Tensor, 
+    scale: torch.Tensor, 
+    bits: int, 
+    in_features: int, 
+    dtype: torch.dtype = torch.float32
+):
+    if bits == 4:
+        q = torch.stack([q & 15, q >> 4], dim=-1).flatten(1)[:, :in_features].to(torch.int8) - 8
+    return q.to(dtype) * scale.to(dtype).unsqueeze(1)
+
+
+class _QuantizedLinear(torch.autograd.Function):
+    # x @ W^T where W is dequantized in forward and again in backward,
+    # so that only the quantized weight is kept alive for the backward pass
+    @staticmethod
+    def forward(ctx, x, weight_q, weight_scale, bits, in_features):
+        ctx.save_for_backward(weight_q, weight_scale)
+        ctx.bits, ctx.in_features = bits, in_features
+        return F.linear(x, dequantize_per_channel(weight_q, weight_scale, bits, in_features, x.dtype))
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        weight_q, weight_scale = ctx.saved_tensors
+        w = dequantize_per_channel(weight_q, weight_scale, ctx.bits, ctx.in_features, grad_output.dtype)
+        return grad_output @ w, None, None, None, None
+
+
+class _LoRAEmbeddingLookup(torch.autograd.Function):
+    # Gathers the columns of lora_A selected by x, i.e. F.embedding(x, lora_A.T),
+    # and returns a sparse gradient for lora_A that only covers the looked up tokens
+    @staticmethod
+    def forward(ctx, x, lora_A, padding_idx):
+        ctx.save_for_backward(x)
+        ctx.num_embeddings, ctx.padding_idx = lora_A.shape[1], padding_idx
+        return lora_A.transpose(0, 1)[x]
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, = ctx.saved_tensors
+        r = grad_output.shape[-1]
+        x, grad_output = x.reshape(-1), grad_output.reshape(-1, r)
+        if ctx.padding_idx is not None:
+            keep = x != ctx.padding_idx
+            x, grad_output = x[keep], grad_output[keep]
+        # Sum the gradients of repeated tokens, then lay them out as the (r, num_embeddings) lora_A
+        tokens, inverse = torch.unique(x, return_inverse=True)
+        values = grad_output.new_zeros((tokens.shape[0], r)).index_add_(0, inverse, grad_output)
+        indices = torch.stack([
+            torch.arange(r, device=x.device).repeat_interleave(tokens.shape[0]),
+            tokens.repeat(r)
+        ])
+        grad_A = torch.sparse_coo_tensor(
+            indices, values.transpose(0, 1).reshape(-1), (r, ctx.num_embeddings)
+        )
+        return None, grad_A, None
+
+
 class LoRALayer():
     def __init__(
         self, 
@@ -27,6 +102,218 @@ class LoRALayer():
         # Mark the weight as unmerged
         self.merged = False
         self.merge_weights = merge_weights
+        # Names of the adapters in the bank, and the adapter applied to each row of the input
+        self.adapter_names = []
+        self.adapter_index = None
+        # Memoize the merged weight of unmerged layers for inference under torch.no_grad()
+        self.cache_merged_weight = True
+        self.clear_weight_cache()
+        # Compensate the rounding error of in-place merges into a half-precision weight
+        self.track_drift = False
+        self.lora_drift = None
+        # Bit width of the frozen weight once quantized by quantize_weight()
+        self.weight_bits = None
+
+    def base_weight(self):
+        # The frozen weight in the (out_features, in_features) layout expected by F.linear
+        if self.weight_bits is not None:
+            return dequantize_per_channel(
+                self.weight_q, self.weight_scale, self.weight_bits, self.in_features, self.weight_scale.dtype
+            )
+        return self.weight.transpose(0, 1) if self.fan_in_fan_out else self.weight
+
+    def base_linear(self, x: torch.Tensor):
+        # F.linear with the frozen weight and bias
+        if self.weight_bits is None:
+            return F.linear(x, self.base_weight(), bias=self.bias)
+        result = _QuantizedLinear.apply(x, self.weight_q, self.weight_scale, self.weight_bits, self.in_features)
+        return result if self.bias is None else result + self.bias
+
+    def _weight_like(self):
+        # A floating point tensor on the device and with the dtype of the frozen weight
+        return self.weight if self.weight_bits is None else self.weight_scale
+
+    def quantize_weight(self, bits: int = 8):
+        # Store the frozen weight as per-channel int8, or packed int4, and dequantize it on the fly.
+        # lora_A and lora_B stay in floating point. The weight is not merged while quantized;
+        # dequantize_weight() restores it together with merge_weights.
+        if not isinstance(self, nn.Linear):
+            raise NotImplementedError(f'Quantization is only supported for Linear and MergedLinear, not {type(self).__name__}')
+        assert not self.merged, 'Unmerge the weights before quantizing them'
+        assert self.weight_bits is None, 'The weight is already quantized'
+        q, scale = quantize_per_channel(self.base_weight(), bits)
+        dtype = self.weight.dtype
+        del self.weight
+        self.register_buffer('weight_q', q)
+        self.register_buffer('weight_scale', scale.to(dtype))
+        self.weight_bits = bits
+        self._merge_weights_unquantized = self.merge_weights
+        self.merge_weights = False
+        self.clear_weight_cache()
+
+    def dequantize_weight(self):
+        assert self.weight_bits is not None, 'The weight is not quantized'
+        w = self.base_weight()
+        del self.weight_q, self.weight_scale
+        self.weight_bits = None
+        self.weight = nn.Parameter(w.transpose(0, 1) if self.fan_in_fan_out else w, requires_grad=False)
+        self.merge_weights = self._merge_weights_unquantized
+        self.clear_weight_cache()
+
+    def _lora_groups(self):
+        # Number of independent (A, B) pairs stacked in lora_A and lora_B
+        return 1
+
+    def _add_low_rank_to_(self, w: torch.Tensor, B: torch.Tensor, A: torch.Tensor):
+        # w += delta-W(B, A) in the layout of the weight, with the scaling already folded into B
+        raise NotImplementedError
+
+    def add_low_rank_(self, B: torch.Tensor, A: torch.Tensor):
+        assert self.weight_bits is None, \
+            'Cannot merge into a quantized weight, call dequantize_weight() first'
+        with torch.no_grad():
+            if not (self.track_drift and self.weight.dtype in [torch.float16, torch.bfloat16]):
+                self._add_low_rank_to_(self.weight.data, B, A)
+                return
+            if self.lora_drift is None or self.lora_drift.device != self.weight.device:
+                self.lora_drift = torch.zeros_like(self.weight.data)
+            # Kahan summation: lora_drift holds the rounding error left by the previous updates
+            y = torch.zeros_like(self.weight.data)
+            self._add_low_rank_to_(y, B, A)
+            y -= self.lora_drift
+            t = self.weight.data + y
+            self.lora_drift = (t - self.weight.data) - y
+            self.weight.data.copy_(t)
+
+    def merge_lora_(self, sign: float = 1.):
+        # weight += sign * delta-W, without materializing delta-W
+        with torch.no_grad():
+            self.add_low_rank_(self.lora_B * (sign * self.scaling), self.lora_A)
+
+    def swap_lora_(self, lora_A: torch.Tensor, lora_B: torch.Tensor):
+        # Replace lora_A and lora_B. A merged weight is moved from the old to the new update with a
+        # single low-rank product of rank r_new + r_old on the difference, instead of an unmerge and a merge.
+        assert lora_A.shape == self.lora_A.shape and lora_B.shape == self.lora_B.shape, \
+            'The new LoRA weights must have the same shapes as the current ones'
+        with torch.no_grad():
+            lora_A, lora_B = lora_A.to(self.lora_A), lora_B.to(self.lora_B)
+            if self.merged:
+                g = self._lora_groups()
+                A = torch.cat([lora_A.view(g, -1, lora_A.shape[-1]), self.lora_A.view(g, -1, lora_A.shape[-1])], dim=1)
+                B = torch.cat([
+                    lora_B.view(g, -1, lora_B.shape[-1]) * self.scaling,
+                    self.lora_B.view(g, -1, lora_B.shape[-1]) * -self.scaling
+                ], dim=2)
+                self.add_low_rank_(B.flatten(0, 1), A.flatten(0, 1))
+            self.lora_A.copy_(lora_A)
+            self.lora_B.copy_(lora_B)
+        self.clear_weight_cache()
+
+    def clear_weight_cache(self):
+        self._merged_weight = None
+        self._merged_weight_key = None
+
+    def use_weight_cache(self):
+        return self.cache_merged_weight and self.weight_bits is None \
+            and not self.training and not torch.is_grad_enabled()
+
+    def merged_weight(self):
+        # Returns the merged weight in the (out_features, in_features) layout expected by F.linear.
+        # The cache is keyed on the storage and version counter of the parameters, so in-place
+        # updates through autograd-visible ops invalidate it. Updates through .data do not bump
+        # the version counter, which is why train() also clears the cache.
+        key = (self.scaling, ) + tuple(
+            (p.data_ptr(), p._version) for p in (self.weight, self.lora_A, self.lora_B)
+        )
+        if self._merged_weight_key != key:
+            self._merged_weight = None
+            self._merged_weight = self.build_merged_weight()
+            self._merged_weight_key = key
+        return self._merged_weight
+
+    def build_merged_weight(self):
+        raise NotImplementedError
+
+    def _adapter_groups(self):
+        # Returns (number of LoRA groups, output features per group)
+        raise NotImplementedError
+
+    def _set_adapter_bank(self, bank_A, bank_B, bank_scaling):
+        # The bank is a serving-time structure, so it is not saved in the state_dict
+        self.register_buffer('lora_bank_A', bank_A, persistent=False)
+        self.register_buffer('lora_bank_B', bank_B, persistent=False)
+        self.register_buffer('lora_bank_scaling', bank_scaling, persistent=False)
+
+    def register_adapter(
+        self,
+        name: str,
+        lora_A: torch.Tensor,
+        lora_B: torch.Tensor,
+        scaling: Optional[float] = None
+    ) -> int:
+        groups, out_per_group = self._adapter_groups()
+        r = lora_A.shape[0] // groups
+        if scaling is None:
+            scaling = self.lora_alpha / r
+        if name in self.adapter_names:
+            self.remove_adapter(name)
+        # The bank stores A as (n, groups, r, in) and B as (n, groups, out_per_group, r)
+        # Adapters of a smaller rank are zero-padded, which does not change their delta. The bank holds
+        # copies, which later updates of e.g. the layer's own lora_A and lora_B leave untouched.
+        A = lora_A.detach().to(self._weight_like(), copy=True).view(1, groups, r, -1)
+        B = lora_B.detach().to(self._weight_like(), copy=True).view(1, groups, out_per_group, r)
+        scaling = self._weight_like().new_tensor([scaling])
+        if self.adapter_names:
+            r_max = max(r, self.lora_bank_A.shape[2])
+            A = torch.cat([
+                F.pad(self.lora_bank_A, (0, 0, 0, r_max - self.lora_bank_A.shape[2])),
+                F.pad(A, (0, 0, 0, r_max - r))
+            ])
+            B = torch.cat([
+                F.pad(self.lora_bank_B, (0, r_max - self.lora_bank_B.shape[-1])),
+                F.pad(B, (0, r_max - r))
+            ])
+            scaling = torch.cat([self.lora_bank_scaling, scaling])
+        self._set_adapter_bank(A, B, scaling)
+        self.adapter_names.append(name)
+        return len(self.adapter_names) - 1
+
+    def remove_adapter(self, name: str):
+        # Indices of the adapters registered after this one are shifted down by one
+        i = self.adapter_names.index(name)
+        self.adapter_names.pop(i)
+        if not self.adapter_names:
+            self._set_adapter_bank(None, None, None)
+            self.adapter_index = None
+            return
+        keep = torch.tensor(
+            [j for j in range(len(self.adapter_names) + 1) if j != i],
+            device=self.lora_bank_A.device
+        )
+        self._set_adapter_bank(
+            self.lora_bank_A.index_select(0, keep),
+            self.lora_bank_B.index_select(0, keep),
+            self.lora_bank_scaling.index_select(0, keep)
+        )
+
+    def adapter_bank_forward(self, x: torch.Tensor):
+        # Applies adapter_index[i] to x[i]; rows with a negative index get no adapter
+        # Returns the delta of shape (*x.shape[:-1], groups * out_per_group)
+        assert not self.merged, 'Unmerge the weights before applying the adapter bank'
+        assert self.adapter_index.shape[0] == x.shape[0], \
+            'adapter_index must have one entry per row of the input'
+        groups, out_per_group = self._adapter_groups()
+        rows, shape = x.shape[0], x.shape[:-1]
+        index = self.adapter_index.to(x.device)
+        bank_index = index.clamp(min=0)
+        A = self.lora_bank_A[bank_index]    # rows, groups, r, in
+        B = self.lora_bank_B[bank_index]    # rows, groups, out_per_group, r
+        scaling = self.lora_bank_scaling[bank_index] * (index >= 0).to(x.dtype)
+        x = self.lora_dropout(x).reshape(rows, -1, x.shape[-1])
+        after_A = torch.bmm(x, A.flatten(1, 2).transpose(1, 2))
+        after_A = after_A.view(rows, -1, groups, A.shape[2])
+        delta = torch.einsum('blgr,bgor->blgo', after_A, B) * scaling.view(-1, 1, 1, 1)
+        return delta.reshape(*shape, groups * out_per_group)
 
 
 class Embedding(nn.Embedding, LoRALayer):
@@ -65,22 +352,31 @@ class Embedding(nn.Embedding, LoRALayer):
             if self.merge_weights and self.merged:
                 # Make sure that the weights are not merged
                 if self.r > 0:
-                    self.weight.data -= (self.lora_B @ self.lora_A).transpose(0, 1) * self.scaling
+                    self.merge_lora_(-1.)
                 self.merged = False
         else:
             if self.merge_weights and not self.merged:
                 # Merge the weights and mark it
                 if self.r > 0:
-                    self.weight.data += (self.lora_B @ self.lora_A).transpose(0, 1) * self.scaling
+                    self.merge_lora_()
                 self.merged = True
+
+    def _add_low_rank_to_(self, w, B, A):
+        w.addmm_(A.transpose(0, 1), B.transpose(0, 1))
         
     def forward(self, x: torch.Tensor):
         if self.r > 0 and not self.merged:
             result = nn.Embedding.forward(self, x)
-            after_A = F.embedding(
-                x, self.lora_A.transpose(0, 1), self.padding_idx, self.max_norm,
-                self.norm_type, self.scale_grad_by_freq, self.sparse
-            )
+            if self.sparse:
+                # Only the looked up tokens receive a gradient, to be used with e.g. torch.optim.SparseAdam
+                assert self.max_norm is None and not self.scale_grad_by_freq, \
+                    'max_norm and scale_grad_by_freq are not supported with sparse LoRA gradients'
+                after_A = _LoRAEmbeddingLookup.apply(x, self.lora_A, self.padding_idx)
+            else:
+                after_A = F.embedding(
+                    x, self.lora_A.transpose(0, 1), self.padding_idx, self.max_norm,
+                    self.norm_type, self.scale_grad_by_freq, self.sparse
+                )
             result += (after_A @ self.lora_B.transpose(0, 1)) * self.scaling
             return result
         else:
@@ -98,6 +394,7 @@ class Linear(nn.Linear, LoRALayer):
         lora_dropout: float = 0.,
         fan_in_fan_out: bool = False, # Set this to True if the layer to replace stores weight like (fan_in, fan_out)
         merge_weights: bool = True,
+        fused: bool = True, # Set this to False to compute the unmerged LoRA update with separate matmuls
         **kwargs
     ):
         nn.Linear.__init__(self, in_features, out_features, **kwargs)
@@ -105,6 +402,7 @@ class Linear(nn.Linear, LoRALayer):
                            merge_weights=merge_weights)
 
         self.fan_in_fan_out = fan_in_fan_out
+        self.fused = fused
         # Actual trainable parameters
         if r > 0:
             self.lora_A = nn.Parameter(self.weight.new_zeros((r, in_features)))
@@ -125,31 +423,57 @@ class Linear(nn.Linear, LoRALayer):
             nn.init.zeros_(self.lora_B)
 
     def train(self, mode: bool = True):
-        def T(w):
-            return w.transpose(0, 1) if self.fan_in_fan_out else w
         nn.Linear.train(self, mode)
+        self.clear_weight_cache()
         if mode:
             if self.merge_weights and self.merged:
                 # Make sure that the weights are not merged
                 if self.r > 0:
-                    self.weight.data -= T(self.lora_B @ self.lora_A) * self.scaling
+                    self.merge_lora_(-1.)
                 self.merged = False
         else:
             if self.merge_weights and not self.merged:
                 # Merge the weights and mark it
                 if self.r > 0:
-                    self.weight.data += T(self.lora_B @ self.lora_A) * self.scaling
+                    self.merge_lora_()
                 self.merged = True       
 
+    def _adapter_groups(self):
+        return 1, self.out_features
+
+    def _add_low_rank_to_(self, w, B, A):
+        if self.fan_in_fan_out:
+            w.addmm_(A.transpose(0, 1), B.transpose(0, 1))
+        else:
+            w.addmm_(B, A)
+
+    def build_merged_weight(self):
+        return self.base_weight() + (self.lora_B @ self.lora_A) * self.scaling
+
     def forward(self, x: torch.Tensor):
-        def T(w):
-            return w.transpose(0, 1) if self.fan_in_fan_out else w
-        if self.r > 0 and not self.merged:
-            result = F.linear(x, T(self.weight), bias=self.bias)            
+        if self.adapter_index is not None:
+            result = self.base_linear(x)
+            result += self.adapter_bank_forward(x)
+            return result
+        elif self.r > 0 and not self.merged and self.use_weight_cache():
+            return F.linear(x, self.merged_weight(), bias=self.bias)
+        elif self.r > 0 and not self.merged and self.fused:
+            result = self.base_linear(x)
+            # Accumulate x @ A^T @ B^T * scaling into the output with a single addmm_
+            # instead of allocating the update and adding it afterwards. Autocast does not cast the
+            # operands of in-place ops, so they are cast to the dtype of the output here.
+            after_A = F.linear(self.lora_dropout(x), self.lora_A)
+            result.view(-1, self.out_features).addmm_(
+                after_A.view(-1, self.r).to(result.dtype), self.lora_B.to(result.dtype).transpose(0, 1),
+                alpha=self.scaling
+            )
+            return result
+        elif self.r > 0 and not self.merged:
+            result = self.base_linear(x)            
             result += (self.lora_dropout(x) @ self.lora_A.transpose(0, 1) @ self.lora_B.transpose(0, 1)) * self.scaling
             return result
         else:
-            return F.linear(x, T(self.weight), bias=self.bias)
+            return self.base_linear(x)
 
 
 class MergedLinear(nn.Linear, LoRALayer):
@@ -164,6 +488,7 @@ class MergedLinear(nn.Linear, LoRALayer):
         enable_lora: List[bool] = [False],
         fan_in_fan_out: bool = False,
         merge_weights: bool = True,
+        low_rank: bool = True, # Set this to False to build the full delta-W with merge_AB() on every unmerged forward
         **kwargs
     ):
         nn.Linear.__init__(self, in_features, out_features, **kwargs)
@@ -173,6 +498,7 @@ class MergedLinear(nn.Linear, LoRALayer):
             'The length of enable_lora must divide out_features'
         self.enable_lora = enable_lora
         self.fan_in_fan_out = fan_in_fan_out
+        self.low_rank = low_rank
         # Actual trainable parameters
         if r > 0 and any(enable_lora):
             self.lora_A = nn.Parameter(
@@ -219,46 +545,106 @@ class MergedLinear(nn.Linear, LoRALayer):
         def T(w):
             return w.transpose(0, 1) if self.fan_in_fan_out else w
         nn.Linear.train(self, mode)
+        self.clear_weight_cache()
         if mode:
             if self.merge_weights and self.merged:
                 # Make sure that the weights are not merged
                 if self.r > 0 and any(self.enable_lora):
-                    self.weight.data -= self.merge_AB() * self.scaling
+                    self.merge_lora_(-1.)
                 self.merged = False
         else:
             if self.merge_weights and not self.merged:
                 # Merge the weights and mark it
                 if self.r > 0 and any(self.enable_lora):
-                    self.weight.data += self.merge_AB() * self.scaling
+                    self.merge_lora_()
                 self.merged = True        
 
+    def _adapter_groups(self):
+        return sum(self.enable_lora), self.out_features // len(self.enable_lora)
+
+    def _lora_groups(self):
+        return sum(self.enable_lora)
+
+    def _add_low_rank_to_(self, w, B, A):
+        g = self._lora_groups()
+        delta_w = torch.bmm(B.view(g, -1, B.shape[-1]), A.view(g, -1, A.shape[-1])).flatten(0, 1)
+        if self.fan_in_fan_out:
+            w.index_add_(1, self.lora_columns(w.device), delta_w.transpose(0, 1))
+        else:
+            w.index_add_(0, self.lora_columns(w.device), delta_w)
+
+    def build_merged_weight(self):
+        def T(w):
+            return w.transpose(0, 1) if self.fan_in_fan_out else w
+        return self.base_weight() + T(self.merge_AB()) * self.scaling
+
+    def lora_columns(self, device):
+        # Output columns that receive a LoRA update, in the order of the rows of lora_B
+        if getattr(self, '_lora_columns', None) is None or self._lora_columns.device != device:
+            self._lora_columns = self.lora_ind.nonzero().view(-1).to(device)
+        return self._lora_columns
+
     def forward(self, x: torch.Tensor):
         def T(w):
             return w.transpose(0, 1) if self.fan_in_fan_out else w
-        if self.merged:
-            return F.linear(x, T(self.weight), bias=self.bias)
+        if self.adapter_index is not None:
+            result = self.base_linear(x)
+            return result.index_add_(-1, self.lora_columns(x.device), self.adapter_bank_forward(x).to(result.dtype))
+        elif self.merged:
+            return self.base_linear(x)
         else:
-            result = F.linear(x, T(self.weight), bias=self.bias)
-            if self.r > 0:
+            if self.r > 0 and self.use_weight_cache():
+                return F.linear(x, self.merged_weight(), bias=self.bias)
+            result = self.base_linear(x)
+            if self.r > 0 and self.low_rank:
+                result.index_add_(-1, self.lora_columns(x.device), self.low_rank_forward(x).to(result.dtype))
+            elif self.r > 0:
                 result += self.lora_dropout(x) @ T(self.merge_AB().T) * self.scaling
             return result
 
+    def low_rank_forward(self, x: torch.Tensor):
+        # Computes x @ A_g^T @ B_g^T * scaling for every enabled group g without building delta-W
+        # Returns the update of the columns given by lora_columns(), of shape (*x.shape[:-1], groups * out_per_group)
+        groups, out_per_group = self._adapter_groups()
+        after_A = F.linear(self.lora_dropout(x), self.lora_A)
+        after_A = after_A.view(*after_A.shape[:-1], groups, self.r)
+        B = self.lora_B.view(groups, out_per_group, self.r) * self.scaling
+        return torch.einsum('...gr,gor->...go', after_A, B).flatten(-2)
+
+
+def _prod(xs):
+    # math.prod requires Python 3.8
+    return functools.reduce(operator.mul, xs, 1)
+
+
 class ConvLoRA(nn.Module, LoRALayer):
-    def __init__(self, conv_module, in_channels, out_channels, kernel_size, r=0, lora_alpha=1, lora_dropout=0., merge_weights=True, **kwargs):
+    def __init__(self, conv_module, in_channels, out_channels, kernel_size, r=0, lora_alpha=1, lora_dropout=0., merge_weights=True, low_rank=False, **kwargs):
         super(ConvLoRA, self).__init__()
         self.conv = conv_module(in_channels, out_channels, kernel_size, **kwargs)
         for name, param in self.conv.named_parameters():
             self.register_parameter(name, param)
         LoRALayer.__init__(self, r=r, lora_alpha=lora_alpha, lora_dropout=lora_dropout, merge_weights=merge_weights)
-        assert isinstance(kernel_size, int)
+        # With low_rank=True, the update is a rank-r convolution followed by a 1x1 expansion, applied as
+        # two convolutions when unmerged. Otherwise the update is (lora_B @ lora_A).view(weight.shape),
+        # and the combined kernel is rebuilt on every unmerged forward.
+        self.low_rank = low_rank
+        kernel_size = self.conv.kernel_size
+        kernel_rest = _prod(kernel_size[1:])
+        groups = self.conv.groups
         # Actual trainable parameters
-        if r > 0:
+        if r > 0 and low_rank:
             self.lora_A = nn.Parameter(
-                self.conv.weight.new_zeros((r * kernel_size, in_channels * kernel_size))
+                self.conv.weight.new_zeros((r * groups, in_channels // groups * _prod(kernel_size)))
+            )
+            self.lora_B = nn.Parameter(self.conv.weight.new_zeros((out_channels, r)))
+        elif r > 0:
+            self.lora_A = nn.Parameter(
+                self.conv.weight.new_zeros((r * kernel_size[0], in_channels * kernel_rest))
             )
             self.lora_B = nn.Parameter(
-              self.conv.weight.new_zeros((out_channels//self.conv.groups*kernel_size, r*kernel_size))
+              self.conv.weight.new_zeros((out_channels//groups*kernel_size[0], r*kernel_size[0]))
             )
+        if r > 0:
             self.scaling = self.lora_alpha / self.r
             # Freezing the pre-trained weight matrix
             self.conv.weight.requires_grad = False
@@ -274,21 +660,50 @@ class ConvLoRA(nn.Module, LoRALayer):
 
     def train(self, mode=True):
         super(ConvLoRA, self).train(mode)
+        self.clear_weight_cache()
         if mode:
             if self.merge_weights and self.merged:
                 if self.r > 0:
                     # Make sure that the weights are not merged
-                    self.conv.weight.data -= (self.lora_B @ self.lora_A).view(self.conv.weight.shape) * self.scaling
+                    self.merge_lora_(-1.)
                 self.merged = False
         else:
             if self.merge_weights and not self.merged:
                 if self.r > 0:
                     # Merge the weights and mark it
-                    self.conv.weight.data += (self.lora_B @ self.lora_A).view(self.conv.weight.shape) * self.scaling
+                    self.merge_lora_()
                 self.merged = True
 
+    def _lora_groups(self):
+        return self.conv.groups if self.low_rank else 1
+
+    def _add_low_rank_to_(self, w, B, A):
+        if self.low_rank:
+            g = self.conv.groups
+            w.view(g, -1, A.shape[-1]).baddbmm_(B.view(g, -1, B.shape[-1]), A.view(g, -1, A.shape[-1]))
+        else:
+            w.view(B.shape[0], A.shape[-1]).addmm_(B, A)
+
+    def build_merged_weight(self):
+        w = self.conv.weight.clone()
+        self._add_low_rank_to_(w, self.lora_B * self.scaling, self.lora_A)
+        return w
+
+    def low_rank_forward(self, x):
+        # Rank-r convolution with the stride, padding and dilation of the layer, then a grouped 1x1 expansion
+        g = self.conv.groups
+        A = self.lora_A.view(self.r * g, -1, *self.conv.kernel_size)
+        B = (self.lora_B * self.scaling).view(*self.lora_B.shape, *([1] * len(self.conv.kernel_size)))
+        after_A = self.conv._conv_forward(self.lora_dropout(x), A, None)
+        conv = [F.conv1d, F.conv2d, F.conv3d][len(self.conv.kernel_size) - 1]
+        return conv(after_A, B, groups=g)
+
     def forward(self, x):
-        if self.r > 0 and not self.merged:
+        if self.r > 0 and not self.merged and self.use_weight_cache():
+            return self.conv._conv_forward(x, self.merged_weight(), self.conv.bias)
+        elif self.r > 0 and not self.merged and self.low_rank:
+            return self.conv(x) + self.low_rank_forward(x)
+        elif self.r > 0 and not self.merged:
             return self.conv._conv_forward(
                 x, 
                 self.conv.weight + (self.lora_B @ self.lora_A).view(self.conv.weight.shape) * self.scaling,
@@ -0,0 +1,128 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import math
+
+import torch
+import torch.nn as nn
+
+from typing import Dict, Mapping, Optional, Tuple
+
+from .layers import LoRALayer, Embedding, Linear, MergedLinear
+
+
+def _is_resizable(m: nn.Module) -> bool:
+    return isinstance(m, (Embedding, Linear, MergedLinear)) and m.r > 0 and hasattr(m, 'lora_A')
+
+
+def lora_svd(layer: LoRALayer) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    # SVD of the scaled update of every LoRA group of the layer, computed from the QR decompositions
+    # of the factors so that B @ A is never formed: B = Q_B R_B, A^T = Q_A R_A, B @ A = Q_B (R_B R_A^T) Q_A^T
+    # Returns U (groups, out, k), S (groups, k) and Vh (groups, k, in) with delta-W = U diag(S) Vh per group
+    g, r = layer._lora_groups(), layer.r
+    with torch.no_grad():
+        B = layer.lora_B.float().view(g, -1, r)
+        A = layer.lora_A.float().view(g, r, -1)
+        Q_B, R_B = torch.linalg.qr(B)
+        Q_A, R_A = torch.linalg.qr(A.transpose(1, 2))
+        U, S, Vh = torch.linalg.svd(R_B @ R_A.transpose(1, 2))
+        return Q_B @ U, S * layer.scaling, Vh @ Q_A.transpose(1, 2)
+
+
+def _set_lora_factors(layer: LoRALayer, B: torch.Tensor, A: torch.Tensor) -> None:
+    # B is (groups, out, r) and A is (groups, r, in); lora_alpha is kept so that scaling stays lora_alpha / r
+    assert not layer.merged, 'Unmerge the weights before changing the rank'
+    r = B.shape[-1]
+    layer.lora_A = nn.Parameter(
+        A.flatten(0, 1).to(layer.lora_A).contiguous(), requires_grad=layer.lora_A.requires_grad
+    )
+    layer.lora_B = nn.Parameter(
+        B.flatten(0, 1).to(layer.lora_B).contiguous(), requires_grad=layer.lora_B.requires_grad
+    )
+    layer.r = r
+    layer.scaling = layer.lora_alpha / r
+    layer.clear_weight_cache()
+
+
+def truncate_lora_rank(layer: LoRALayer, r: int) -> None:
+    # Rewrite lora_A and lora_B as the best rank-r approximation of the current update
+    U, S, Vh = lora_svd(layer)
+    k = min(r, S.shape[-1])
+    # Split the singular values evenly between the factors, and undo the new scaling
+    S = (S[:, :k] * r / layer.lora_alpha).sqrt()
+    B = torch.zeros(U.shape[0], U.shape[1], r, device=U.device)
+    A = torch.zeros(Vh.shape[0], r, Vh.shape[2], device=Vh.device)
+    B[:, :, :k] = U[:, :, :k] * S.unsqueeze(1)
+    A[:, :k] = Vh[:, :k] * S.unsqueeze(2)
+    _set_lora_factors(layer, B, A)
+
+
+def _energy_rank(S: torch.Tensor, energy: float) -> int:
+    # Smallest rank keeping the given fraction of the squared singular values, over all groups
+    total = S.pow(2).sum(-1, keepdim=True).clamp(min=1e-12)
+    kept = S.pow(2).cumsum(-1) / total
+    return min(int((kept < energy).sum(-1).max()) + 1, S.shape[-1])
+
+
+def prune_lora_rank(
+    model: nn.Module,
+    energy: Optional[float] = None,
+    param_budget: Optional[int] = None,
+    min_rank: int = 1
+) -> Dict[str, int]:
+    # Truncate every LoRA layer to the rank that keeps a fraction `energy` of its update, or allocate
+    # `param_budget` LoRA parameters across layers to the largest singular values of the whole model.
+    # Returns the new rank of every layer, which set_lora_ranks() takes to build a matching model.
+    # The layers get new lora_A and lora_B parameters, so optimizers must be created afterwards.
+    assert (energy is None) != (param_budget is None), 'Pass exactly one of energy and param_budget'
+    layers = {n: m for n, m in model.named_modules() if _is_resizable(m)}
+    spectra = {n: lora_svd(m)[1] for n, m in layers.items()}
+
+    if energy is not None:
+        ranks = {n: max(min_rank, _energy_rank(S, energy)) for n, S in spectra.items()}
+    else:
+        # Every rank of a layer costs one row of A and one column of B in each of its groups
+        cost = {n: m.lora_A.numel() // m.r + m.lora_B.numel() // m.r for n, m in layers.items()}
+        ranks = {n: min_rank for n in layers}
+        budget = param_budget - sum(cost[n] * min_rank for n in layers)
+        candidates = sorted(
+            ((float(S[:, j].max()), n, j) for n, S in spectra.items() for j in range(min_rank, S.shape[-1])),
+            reverse=True
+        )
+        for _, n, j in candidates:
+            # Singular values of a layer are sorted, so the kept ones always form a prefix
+            if j == ranks[n] and cost[n] <= budget:
+                ranks[n] += 1
+                budget -= cost[n]
+
+    for n, m in layers.items():
+        if ranks[n] < m.r:
+            truncate_lora_rank(m, ranks[n])
+    return ranks
+
+
+def lora_rank_map(state_dict: Mapping[str, torch.Tensor]) -> Dict[str, int]:
+    # Rank of every LoRA layer found in a state_dict, keyed by module name
+    return {
+        k[:-len('lora_B')].rstrip('.'): v.shape[-1]
+        for k, v in state_dict.items() if k.endswith('lora_B')
+    }
+
+
+def set_lora_ranks(model: nn.Module, rank_map: Mapping[str, int]) -> None:
+    # Re-create lora_A and lora_B of the named layers with the given ranks, initialized like a new layer,
+    # e.g. before loading a checkpoint pruned by prune_lora_rank() or to train with a rank per module
+    modules = dict(model.named_modules())
+    for n, r in rank_map.items():
+        m = modules.get(n)
+        if m is None or not _is_resizable(m) or m.r == r:
+            continue
+        g = m._lora_groups()
+        B = m.lora_B.new_zeros((g, m.lora_B.shape[0] // g, r))
+        A = m.lora_A.new_zeros((g, r, m.lora_A.shape[-1]))
+        _set_lora_factors(m, B, A)
+        if isinstance(m, Embedding):
+            nn.init.normal_(m.lora_B)
+        else:
+            nn.init.kaiming_uniform_(m.lora_A, a=math.sqrt(5))
@@ -0,0 +1,130 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import fnmatch
+import math
+
+import torch
+import torch.nn as nn
+
+from typing import List, Optional, Sequence
+
+from .layers import LoRALayer, Embedding, Linear, ConvLoRA, Conv1d, Conv2d, Conv3d
+
+
+_CONV_LAYERS = {nn.Conv1d: Conv1d, nn.Conv2d: Conv2d, nn.Conv3d: Conv3d}
+
+
+def _is_gpt2_conv1d(m: nn.Module) -> bool:
+    # The Conv1D of GPT-2 is a linear layer with its weight stored as (in_features, out_features)
+    return type(m).__name__ == 'Conv1D' and hasattr(m, 'nf') and m.weight.dim() == 2
+
+
+def _lora_layer_for(m: nn.Module, r: int, lora_alpha: int, lora_dropout: float, merge_weights: bool, **kwargs):
+    # A LoRA layer matching m, built on the meta device so that its frozen weight is never allocated
+    lora_kwargs = dict(r=r, lora_alpha=lora_alpha, merge_weights=merge_weights, device='meta')
+    if type(m) is nn.Linear:
+        return Linear(
+            m.in_features, m.out_features, lora_dropout=lora_dropout, bias=m.bias is not None,
+            **lora_kwargs, **kwargs
+        )
+    elif _is_gpt2_conv1d(m):
+        return Linear(
+            m.weight.shape[0], m.weight.shape[1], lora_dropout=lora_dropout, bias=m.bias is not None,
+            fan_in_fan_out=True, **lora_kwargs, **kwargs
+        )
+    elif type(m) is nn.Embedding:
+        return Embedding(
+            m.num_embeddings, m.embedding_dim, padding_idx=m.padding_idx, max_norm=m.max_norm,
+            norm_type=m.norm_type, scale_grad_by_freq=m.scale_grad_by_freq, sparse=m.sparse,
+            **lora_kwargs, **kwargs
+        )
+    elif type(m) in _CONV_LAYERS:
+        return _CONV_LAYERS[type(m)](
+            m.in_channels, m.out_channels, m.kernel_size, lora_dropout=lora_dropout, stride=m.stride,
+            padding=m.padding, dilation=m.dilation, groups=m.groups, bias=m.bias is not None,
+            padding_mode=m.padding_mode, **lora_kwargs, **kwargs
+        )
+    raise NotImplementedError(f'LoRA is not supported for {type(m).__name__}')
+
+
+def _share_parameters(layer: LoRALayer, m: nn.Module) -> None:
+    # Point the frozen parameters of layer at the ones of m, and allocate lora_A and lora_B next to them
+    targets = [layer, layer.conv] if isinstance(layer, ConvLoRA) else [layer]
+    for k, p in m.named_parameters(recurse=False):
+        for t in targets:
+            setattr(t, k, p)
+    if layer.r > 0:
+        layer.weight.requires_grad = False
+        for k in ['lora_A', 'lora_B']:
+            p = getattr(layer, k)
+            setattr(layer, k, nn.Parameter(torch.empty(p.shape, device=m.weight.device, dtype=m.weight.dtype)))
+        # The same initialization as reset_parameters() of the layer, which would also reset the weight
+        if isinstance(layer, Embedding):
+            nn.init.zeros_(layer.lora_A)
+            nn.init.normal_(layer.lora_B)
+        else:
+            nn.init.kaiming_uniform_(layer.lora_A, a=math.sqrt(5))
+            nn.init.zeros_(layer.lora_B)
+
+
+def _refresh_lora_index(model: nn.Module) -> None:
+    index = model.__dict__.get('_lora_index')
+    if index is not None:
+        index.refresh()
+
+
+def inject_lora(
+    model: nn.Module,
+    target_modules: Sequence[str],
+    r: int,
+    lora_alpha: int = 1,
+    lora_dropout: float = 0.,
+    merge_weights: bool = True,
+    **kwargs
+) -> List[str]:
+    # Replace the nn.Linear, nn.Embedding, nn.Conv1d/2d/3d and GPT-2 Conv1D modules whose names match
+    # one of the fnmatch patterns in target_modules with LoRA layers. The LoRA layers share the weight
+    # and bias of the modules they replace, so no weight is copied. Extra kwargs go to the LoRA layers.
+    # Returns the names of the replaced modules; eject_lora() puts the original modules back.
+    replaced = []
+    for n, m in list(model.named_modules()):
+        if not n or isinstance(m, LoRALayer) or not any(fnmatch.fnmatchcase(n, p) for p in target_modules):
+            continue
+        if not (type(m) in [nn.Linear, nn.Embedding] or type(m) in _CONV_LAYERS or _is_gpt2_conv1d(m)):
+            continue
+        layer = _lora_layer_for(m, r, lora_alpha, lora_dropout, merge_weights, **kwargs)
+        weight_requires_grad = m.weight.requires_grad
+        _share_parameters(layer, m)
+        layer.train(m.training)
+        # Keep the original module, outside of the module tree, to restore it later
+        layer.__dict__['lora_source'] = (m, weight_requires_grad)
+        parent_name, _, child_name = n.rpartition('.')
+        setattr(model.get_submodule(parent_name), child_name, layer)
+        replaced.append(n)
+    _refresh_lora_index(model)
+    return replaced
+
+
+def eject_lora(model: nn.Module, merge: bool = False, target_modules: Optional[Sequence[str]] = None) -> List[str]:
+    # Put back the modules replaced by inject_lora(). With merge=True, the LoRA update is kept
+    # in the shared weight, otherwise the weight is restored to its pretrained value.
+    ejected = []
+    for n, m in list(model.named_modules()):
+        source = m.__dict__.get('lora_source')
+        if source is None:
+            continue
+        if target_modules is not None and not any(fnmatch.fnmatchcase(n, p) for p in target_modules):
+            continue
+        assert m.weight_bits is None, 'Dequantize the weight before ejecting the LoRA layer'
+        source, weight_requires_grad = source
+        if m.r > 0 and m.merged != merge:
+            m.merge_lora_(1. if merge else -1.)
+        source.weight.requires_grad = weight_requires_grad
+        source.train(m.training)
+        parent_name, _, child_name = n.rpartition('.')
+        setattr(model.get_submodule(parent_name), child_name, source)
+        ejected.append(n)
+    _refresh_lora_index(model)
+    return ejected
@@ -2,48 +2,252 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
+import fnmatch
+import json
+import os
+
 import torch
 import torch.nn as nn
 
-from typing import Dict
-
-from .layers import LoRALayer
-
-
-def mark_only_lora_as_trainable(model: nn.Module, bias: str = 'none') -> None:
-    for n, p in model.named_parameters():
-        if 'lora_' not in n:
-            p.requires_grad = False
-    if bias == 'none':
-        return
-    elif bias == 'all':
-        for n, p in model.named_parameters():
-            if 'bias' in n:
-                p.requires_grad = True
-    elif bias == 'lora_only':
-        for m in model.modules():
-            if isinstance(m, LoRALayer) and \
-                hasattr(m, 'bias') and \
-                m.bias is not None:
-                    m.bias.requires_grad = True
-    else:
-        raise NotImplementedError
-
-
-def lora_state_dict(model: nn.Module, bias: str = 'none') -> Dict[str, torch.Tensor]:
-    my_state_dict = model.state_dict()
-    if bias == 'none':
-        return {k: my_state_dict[k] for k in my_state_dict if 'lora_' in k}
-    elif bias == 'all':
-        return {k: my_state_dict[k] for k in my_state_dict if 'lora_' in k or 'bias' in k}
-    elif bias == 'lora_only':
-        to_return = {}
-        for k in my_state_dict:
-            if 'lora_' in k:
-                to_return[k] = my_state_dict[k]
-                bias_name = k.split('lora_')[0]+'bias'
-                if bias_name in my_state_dict:
-                    to_return[bias_name] = my_state_dict[bias_name]
-        return to_return
-    else:
-        raise NotImplementedError
+from typing import Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+from .layers import LoRALayer, Linear, MergedLinear
+
+
+LORA_INDEX_NAME = 'lora_index.json'
+
+
+class LoRAIndex:
+    # Classifies every parameter of a model once, from the module tree rather than from parameter names:
+    # the LoRA parameters of LoRALayer instances, the biases owned by those layers, and all other biases.
+    # include and exclude are fnmatch patterns on module names selecting the LoRA layers to index.
+    # Parameters are looked up through their modules on use, so replacing lora_A and lora_B (e.g. with
+    # set_lora_ranks) keeps the index valid. get_lora_index() refreshes it when modules are added,
+    # removed or replaced.
+    def __init__(
+        self, 
+        model: nn.Module, 
+        include: Optional[Sequence[str]] = None, 
+        exclude: Optional[Sequence[str]] = None
+    ):
+        self.model = model
+        self.include = tuple(include) if include is not None else None
+        self.exclude = tuple(exclude) if exclude is not None else ()
+        self.refresh()
+
+    def _selected(self, name: str) -> bool:
+        if self.include is not None and not any(fnmatch.fnmatchcase(name, p) for p in self.include):
+            return False
+        return not any(fnmatch.fnmatchcase(name, p) for p in self.exclude)
+
+    def refresh(self) -> None:
+        # (name, module, attribute, kind) in the order of model.named_parameters(), kind being one of
+        # 'lora', 'lora_bias', 'bias' and None
+        self.entries, self.layers = [], []
+        # Kept to detect changes of the module tree, see is_stale()
+        self.modules = list(self.model.modules())
+        seen = set()
+        for n, m in self.model.named_modules():
+            prefix = n + '.' if n else ''
+            is_lora = isinstance(m, LoRALayer) and self._selected(n)
+            if is_lora:
+                self.layers.append((n, m))
+            for k, p in m._parameters.items():
+                if p is None or id(p) in seen:
+                    continue
+                seen.add(id(p))
+                if is_lora and k.startswith('lora_'):
+                    kind = 'lora'
+                elif k == 'bias':
+                    kind = 'lora_bias' if is_lora else 'bias'
+                else:
+                    kind = None
+                self.entries.append((prefix + k, m, k, kind))
+
+    def is_stale(self) -> bool:
+        # Whether modules were added, removed or replaced since the last refresh(). The index holds the
+        # modules, so a new module cannot reuse the identity of an old one.
+        n = 0
+        for n, m in enumerate(self.model.modules(), 1):
+            if n > len(self.modules) or self.modules[n - 1] is not m:
+                return True
+        return n != len(self.modules)
+
+    def named_parameters(self, bias: str = 'none') -> Iterator[Tuple[str, nn.Parameter]]:
+        # The LoRA parameters, plus the biases of the LoRA layers (bias='lora_only') or all biases (bias='all')
+        if bias == 'none':
+            kinds = ('lora',)
+        elif bias == 'all':
+            kinds = ('lora', 'lora_bias', 'bias')
+        elif bias == 'lora_only':
+            kinds = ('lora', 'lora_bias')
+        else:
+            raise NotImplementedError
+        for n, m, k, kind in self.entries:
+            p = m._parameters.get(k)
+            if kind in kinds and p is not None:
+                yield n, p
+
+    def parameters(self, bias: str = 'none') -> List[nn.Parameter]:
+        return [p for _, p in self.named_parameters(bias=bias)]
+
+    def all_parameters(self) -> Iterator[nn.Parameter]:
+        for _, m, k, _ in self.entries:
+            p = m._parameters.get(k)
+            if p is not None:
+                yield p
+
+
+def get_lora_index(
+    model: nn.Module, 
+    include: Optional[Sequence[str]] = None, 
+    exclude: Optional[Sequence[str]] = None, 
+    refresh: bool = False
+) -> LoRAIndex:
+    # The LoRAIndex of the model, built on first use and kept on the model for the same patterns.
+    # It is refreshed whenever the module tree changed, which costs one walk over the modules.
+    index = model.__dict__.get('_lora_index')
+    patterns = (tuple(include) if include is not None else None, tuple(exclude) if exclude is not None else ())
+    if index is None or (index.include, index.exclude) != patterns:
+        index = LoRAIndex(model, include=include, exclude=exclude)
+        model.__dict__['_lora_index'] = index
+    elif refresh or index.is_stale():
+        index.refresh()
+    return index
+
+
+def mark_only_lora_as_trainable(
+    model: nn.Module, 
+    bias: str = 'none', 
+    include: Optional[Sequence[str]] = None, 
+    exclude: Optional[Sequence[str]] = None
+) -> None:
+    index = get_lora_index(model, include=include, exclude=exclude)
+    trainable = set(id(p) for p in index.parameters(bias=bias))
+    for p in index.all_parameters():
+        p.requires_grad = id(p) in trainable
+
+
+def lora_parameters(
+    model: nn.Module, 
+    bias: str = 'none', 
+    include: Optional[Sequence[str]] = None, 
+    exclude: Optional[Sequence[str]] = None
+) -> List[nn.Parameter]:
+    # The parameters marked trainable by mark_only_lora_as_trainable(), e.g. to build an optimizer
+    return get_lora_index(model, include=include, exclude=exclude).parameters(bias=bias)
+
+
+def iter_lora_state_dict(
+    model: nn.Module, 
+    bias: str = 'none', 
+    include: Optional[Sequence[str]] = None, 
+    exclude: Optional[Sequence[str]] = None
+) -> Iterator[Tuple[str, torch.Tensor]]:
+    # Yields the LoRA tensors one by one, without building model.state_dict()
+    index = get_lora_index(model, include=include, exclude=exclude)
+    for k, p in index.named_parameters(bias=bias):
+        yield k, p.detach()
+
+
+def lora_state_dict(
+    model: nn.Module, 
+    bias: str = 'none', 
+    include: Optional[Sequence[str]] = None, 
+    exclude: Optional[Sequence[str]] = None
+) -> Dict[str, torch.Tensor]:
+    return dict(iter_lora_state_dict(model, bias=bias, include=include, exclude=exclude))
+
+
+def save_lora_state_dict(
+    model: nn.Module, 
+    save_directory: str, 
+    bias: str = 'none', 
+    max_shard_size: int = 1 << 30, 
+    include: Optional[Sequence[str]] = None, 
+    exclude: Optional[Sequence[str]] = None
+) -> None:
+    # Streams the LoRA tensors into shards of at most max_shard_size bytes, plus a small index
+    # mapping every tensor to its shard, in the spirit of the sharded checkpoints of Hugging Face
+    os.makedirs(save_directory, exist_ok=True)
+    shards, shard_size, total_size = [{}], 0, 0
+    for k, t in iter_lora_state_dict(model, bias=bias, include=include, exclude=exclude):
+        size = t.numel() * t.element_size()
+        if shards[-1] and shard_size + size > max_shard_size:
+            shards.append({})
+            shard_size = 0
+        shards[-1][k] = t
+        shard_size += size
+        total_size += size
+    weight_map = {}
+    for i, shard in enumerate(shards):
+        shard_file = f'lora_shard_{i:05d}.pt'
+        torch.save(shard, os.path.join(save_directory, shard_file))
+        weight_map.update({k: shard_file for k in shard})
+    with open(os.path.join(save_directory, LORA_INDEX_NAME), 'w') as writer:
+        json.dump({'metadata': {'total_size': total_size}, 'weight_map': weight_map}, writer, indent=2)
+
+
+def load_lora_state_dict(save_directory: str, map_location=None) -> Dict[str, torch.Tensor]:
+    with open(os.path.join(save_directory, LORA_INDEX_NAME), 'r') as reader:
+        weight_map = json.load(reader)['weight_map']
+    state_dict = {}
+    for shard_file in sorted(set(weight_map.values())):
+        state_dict.update(torch.load(os.path.join(save_directory, shard_file), map_location=map_location))
+    return state_dict
+
+
+def register_adapter(
+    model: nn.Module, 
+    name: str, 
+    state_dict: Dict[str, torch.Tensor], 
+    scaling: Optional[float] = None
+) -> int:
+    # Add the adapter in state_dict (as returned by lora_state_dict) to the bank of every LoRA layer it covers
+    index = None
+    for n, m in model.named_modules():
+        prefix = n + '.' if n else ''
+        if isinstance(m, LoRALayer) and prefix + 'lora_A' in state_dict:
+            index = m.register_adapter(
+                name, state_dict[prefix + 'lora_A'], state_dict[prefix + 'lora_B'], scaling=scaling
+            )
+    assert index is not None, f'No LoRA weights of the model found for adapter {name}'
+    return index
+
+
+def remove_adapter(model: nn.Module, name: str) -> None:
+    for m in model.modules():
+        if isinstance(m, LoRALayer) and name in m.adapter_names:
+            m.remove_adapter(name)
+
+
+def set_adapter_index(model: nn.Module, adapter_index: Optional[torch.Tensor]) -> None:
+    # adapter_index[i] is the bank index of the adapter applied to the i-th row of the batch,
+    # -1 leaves the row without adapter. Pass None to go back to the layers' own lora_A and lora_B.
+    for m in model.modules():
+        if isinstance(m, LoRALayer) and (adapter_index is None or m.adapter_names):
+            m.adapter_index = adapter_index
+
+
+def swap_adapter(
+    model: nn.Module, 
+    state_dict: Mapping[str, torch.Tensor], 
+    track_drift: Optional[bool] = None
+) -> None:
+    # Replace the LoRA weights of every layer covered by state_dict, e.g. the output of lora_state_dict
+    # or a LoRACheckpoint. Merged layers stay merged and are updated in place on the difference of the
+    # two updates. With track_drift=True, half-precision weights keep a compensation of the rounding
+    # error so that repeated swaps do not accumulate it.
+    for n, m in model.named_modules():
+        prefix = n + '.' if n else ''
+        if isinstance(m, LoRALayer) and prefix + 'lora_A' in state_dict:
+            if track_drift is not None:
+                m.track_drift = track_drift
+            m.swap_lora_(state_dict[prefix + 'lora_A'], state_dict[prefix + 'lora_B'])
+
+
+def quantize_base_weights(model: nn.Module, bits: int = 8) -> None:
+    # Quantize the frozen weight of every lora.Linear and lora.MergedLinear, see LoRALayer.quantize_weight()
+    for m in model.modules():
+        if isinstance(m, (Linear, MergedLinear)) and m.weight_bits is None:
+            m.quantize_weight(bits)
@@ -0,0 +1,46 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import os
+import sys
+
+import pytest
+import torch
+
+import loralib as lora
+
+# The GPT-2 example is a directory of scripts that import each other by module name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples', 'NLG', 'src'))
+
+
+@pytest.fixture
+def gpt2_model():
+    # Builds a small GPT-2 with LoRA in the attention, whose lora_B is not zero so that LoRA
+    # takes part in the outputs. Models built with the same arguments have the same weights.
+    from model import GPT2Config, GPT2LMModel
+
+    def make(**kwargs):
+        config = dict(
+            vocab_size_or_config_json_file=64, n_positions=64, n_ctx=64, n_embd=32, n_layer=2, n_head=4,
+            lora_attn_dim=4, lora_attn_alpha=8
+        )
+        config.update(kwargs)
+        torch.manual_seed(0)
+        model = GPT2LMModel(GPT2Config(**config))
+        for m in model.modules():
+            if isinstance(m, lora.LoRALayer) and hasattr(m, 'lora_B'):
+                torch.nn.init.normal_(m.lora_B, std=0.02)
+        return model.eval()
+    return make
+
+
+@pytest.fixture(scope='session')
+def process_group(tmp_path_factory):
+    # beam() and sample() gather the predictions over the process group, of a single process here
+    import torch.distributed as dist
+    dist.init_process_group(
+        'gloo', init_method='file://' + str(tmp_path_factory.mktemp('dist') / 'init'), rank=0, world_size=1
+    )
+    yield dist
+    dist.destroy_process_group()
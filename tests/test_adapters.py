@@ -0,0 +1,72 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import pytest
+import torch
+
+import loralib as lora
+
+LAYERS = [(lora.Linear, {}), (lora.MergedLinear, {'enable_lora': [True, False, True]})]
+
+
+def _groups(layer):
+    return sum(layer.enable_lora) if isinstance(layer, lora.MergedLinear) else 1
+
+
+@pytest.mark.parametrize('fan_in_fan_out', [False, True])
+@pytest.mark.parametrize('cls, kwargs', LAYERS)
+def test_adapter_bank_matches_each_adapter(cls, kwargs, fan_in_fan_out):
+    torch.manual_seed(0)
+
+    def make(r):
+        return cls(8, 12, r=r, lora_alpha=8, fan_in_fan_out=fan_in_fan_out, merge_weights=False, **kwargs)
+
+    layer = make(4)
+    g = _groups(layer)
+    # Adapters of different ranks, applied to one row each, and no adapter for the last row
+    adapters = [(torch.randn(r * g, 8), torch.randn(layer.lora_B.shape[0], r)) for r in [4, 2]]
+    for name, (A, B) in zip(['a', 'b'], adapters):
+        layer.register_adapter(name, A, B)
+    layer.adapter_index = torch.tensor([0, 1, -1])
+    x = torch.randn(3, 5, 8)
+    result = layer(x)
+
+    for i, adapter in enumerate(adapters + [None]):
+        ref = make(0 if adapter is None else adapter[1].shape[1])
+        ref.weight.data.copy_(layer.weight)
+        ref.bias.data.copy_(layer.bias)
+        if adapter is not None:
+            ref.lora_A.data.copy_(adapter[0])
+            ref.lora_B.data.copy_(adapter[1])
+        assert torch.allclose(result[i], ref(x[i:i + 1])[0], atol=1e-4)
+
+    # The adapters registered after a removed one move down by one
+    layer.remove_adapter('a')
+    layer.adapter_index = torch.tensor([-1, 0, -1])
+    assert torch.allclose(layer(x)[1], result[1], atol=1e-4)
+
+
+def test_model_adapter_bank_matches_own_lora():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(
+        lora.Linear(8, 16, r=4, lora_alpha=8, merge_weights=False),
+        torch.nn.ReLU(),
+        lora.MergedLinear(16, 12, r=2, lora_alpha=8, enable_lora=[True, False, True], merge_weights=False),
+    )
+    for m in model.modules():
+        if isinstance(m, lora.LoRALayer):
+            torch.nn.init.normal_(m.lora_B)
+    x = torch.randn(2, 8)
+    expected = model(x)
+
+    assert lora.register_adapter(model, 'own', lora.lora_state_dict(model)) == 0
+    for m in model.modules():
+        if isinstance(m, lora.LoRALayer):
+            torch.nn.init.zeros_(m.lora_B)
+    lora.set_adapter_index(model, torch.tensor([0, 0]))
+    assert torch.allclose(model(x), expected, atol=1e-4)
+
+    lora.set_adapter_index(model, None)
+    lora.remove_adapter(model, 'own')
+    assert not model[0].adapter_names and not model[2].adapter_names
@@ -0,0 +1,34 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import pytest
+import torch
+
+import loralib as lora
+
+
+def _autocast_devices():
+    devices = [('cpu', torch.bfloat16)]
+    if torch.cuda.is_available():
+        devices.append(('cuda', torch.float16))
+    return devices
+
+
+@pytest.mark.parametrize('device, dtype', _autocast_devices())
+@pytest.mark.parametrize('fused', [True, False])
+def test_linear_autocast(device, dtype, fused):
+    torch.manual_seed(0)
+    layer = lora.Linear(16, 32, r=4, lora_alpha=8, fused=fused).to(device)
+    torch.nn.init.normal_(layer.lora_B)
+    layer.train()
+    x = torch.randn(2, 3, 16, device=device)
+    expected = layer(x)
+
+    with torch.autocast(device_type=device, dtype=dtype):
+        result = layer(x)
+    result.float().sum().backward()
+
+    assert result.dtype == dtype
+    assert torch.allclose(result.float(), expected, atol=1e-1, rtol=1e-2)
+    assert layer.lora_A.grad is not None and layer.lora_B.grad is not None
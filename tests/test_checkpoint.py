@@ -0,0 +1,79 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import pytest
+import torch
+
+import loralib as lora
+
+
+def _model(seed=0):
+    # The same frozen weights for every seed, and LoRA weights depending on the seed
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(
+        lora.Linear(8, 16, r=4),
+        torch.nn.ReLU(),
+        lora.MergedLinear(16, 12, r=2, enable_lora=[True, False, True]),
+    )
+    torch.manual_seed(seed)
+    for p in lora.lora_parameters(model):
+        torch.nn.init.normal_(p)
+    return model
+
+
+def _assert_equal(state_dict, expected):
+    assert set(state_dict) == set(expected)
+    for k in expected:
+        assert state_dict[k].dtype == expected[k].dtype and torch.equal(state_dict[k], expected[k])
+
+
+def test_lora_checkpoint_round_trip(tmp_path):
+    state_dict = {
+        'a': torch.randn(3, 5),
+        'b': torch.randn(7).to(torch.bfloat16),
+        'c': torch.arange(6).view(2, 3),
+        'd': torch.zeros(0, 4),
+    }
+    lora.save_lora_checkpoint(state_dict, str(tmp_path / 'lora.bin'))
+    _assert_equal(dict(lora.load_lora_checkpoint(str(tmp_path / 'lora.bin'))), state_dict)
+
+    lora.convert_lora_checkpoint_to_pt(str(tmp_path / 'lora.bin'), str(tmp_path / 'lora.pt'))
+    _assert_equal(torch.load(str(tmp_path / 'lora.pt')), state_dict)
+    lora.convert_pt_to_lora_checkpoint(str(tmp_path / 'lora.pt'), str(tmp_path / 'converted.bin'))
+    _assert_equal(dict(lora.load_lora_checkpoint(str(tmp_path / 'converted.bin'))), state_dict)
+
+
+@pytest.mark.parametrize('lazy', [True, False])
+@pytest.mark.parametrize('train', [True, False])
+def test_attach_lora_checkpoint(tmp_path, lazy, train):
+    path = str(tmp_path / 'lora.bin')
+    lora.save_lora_checkpoint(lora.lora_state_dict(_model(seed=1)), path)
+    x = torch.randn(2, 8)
+    with torch.no_grad():
+        expected = _model(seed=1).train(train)(x)
+
+    # Eval mode merges the old LoRA weights, which are replaced on attach
+    model = _model().train(train)
+    lora.attach_lora_checkpoint(model, path, lazy=lazy)
+    with torch.no_grad():
+        assert torch.allclose(model(x), expected, atol=1e-4)
+    _assert_equal(lora.lora_state_dict(model), lora.lora_state_dict(_model(seed=1)))
+
+
+def test_attached_weights_do_not_alias_the_checkpoint(tmp_path):
+    paths = [str(tmp_path / 'a.bin'), str(tmp_path / 'b.bin')]
+    for seed, path in enumerate(paths, 1):
+        lora.save_lora_checkpoint(lora.lora_state_dict(_model(seed=seed)), path)
+    checkpoint = lora.load_lora_checkpoint(paths[0])
+    model = _model().eval()
+    x = torch.randn(2, 8)
+
+    lora.attach_lora_checkpoint(model, checkpoint, lazy=False)
+    with torch.no_grad():
+        expected = model(x)
+        # Updating the attached weights in place leaves the checkpoint untouched
+        lora.swap_adapter(model, lora.load_lora_checkpoint(paths[1]))
+        _assert_equal(dict(checkpoint), lora.lora_state_dict(_model(seed=1)))
+        lora.attach_lora_checkpoint(model, checkpoint, lazy=False)
+        assert torch.allclose(model(x), expected, atol=1e-4)
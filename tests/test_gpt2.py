@@ -0,0 +1,138 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import pytest
+import torch
+
+import loralib as lora
+
+
+def _tokens(batch_size=2, seq_len=10):
+    return torch.randint(0, 64, (batch_size, seq_len), generator=torch.Generator().manual_seed(0))
+
+
+@pytest.mark.parametrize('sdpa', [True, False])
+def test_fused_attention_matches_eager(gpt2_model, monkeypatch, sdpa):
+    if not sdpa:
+        # Attention over chunks of queries, for versions of PyTorch without the fused kernels
+        monkeypatch.delattr(torch.nn.functional, 'scaled_dot_product_attention', raising=False)
+    eager, fused = gpt2_model(), gpt2_model(fused_attn=True, attn_chunk_size=3)
+    tokens = _tokens()
+    len_past = torch.tensor([5, 7])
+
+    with torch.no_grad():
+        outputs = []
+        for model in [eager, fused]:
+            logits, presents = model(tokens)
+            # One more token per row at len_past, as in beam search
+            step, _ = model(tokens[:, -1:], past=presents, len_past=len_past)
+            outputs.append((logits, step))
+    for out, ref in zip(outputs[1], outputs[0]):
+        assert torch.allclose(out, ref, atol=1e-5)
+
+
+@pytest.mark.parametrize('cache', ['static', 'paged'])
+def test_kv_cache_decoding_matches_full_forward(gpt2_model, cache):
+    model = gpt2_model()
+    tokens = _tokens(3, 12)
+    with torch.no_grad():
+        expected, _ = model(tokens)
+        if cache == 'static':
+            past = model.transformer.allocate_kv_cache(3, 16)
+        else:
+            past = model.transformer.allocate_paged_kv_cache(32, block_size=4)
+            past.start(3)
+        logits, past = model(tokens[:, :5], past=past)
+        steps = [logits]
+        # Then one token at a time, either after the positions in use or at len_past
+        for i in range(5, 12):
+            len_past = torch.full((3, ), i) if i % 2 else None
+            logits, past = model(tokens[:, i:i + 1], past=past, len_past=len_past)
+            steps.append(logits)
+    assert torch.allclose(torch.cat(steps, dim=1), expected, atol=1e-5)
+
+
+def test_report_accuracy(gpt2_model):
+    model = gpt2_model()
+    tokens = _tokens(4, 8)
+    with torch.no_grad():
+        logits, _ = model(tokens)
+        pred = logits.argmax(dim=-1)
+        # Hits and misses at the target positions, and a row without targets
+        labels = torch.where(torch.arange(8) % 3 == 0, (pred + 1) % 64, pred)
+        labels[1, 3:] = pred[1, 3:]
+        lm_mask = torch.zeros(4, 8)
+        lm_mask[:3, 3:7] = 1.0
+        lm_mask[2, 3] = 0.0
+        _, _, t1_acc, all_acc, tok_acc = model(tokens, lm_labels=labels, lm_mask=lm_mask, is_report_accuracy=True)
+
+    hit = (pred == labels) & (lm_mask >= 1.0)
+    for b in range(4):
+        valid = (lm_mask[b] >= 1.0).nonzero().view(-1).tolist()
+        assert t1_acc[b] == float(bool(valid) and bool(hit[b, valid[0]]))
+        assert all_acc[b] == float(all(hit[b, i] for i in valid))
+        assert tok_acc[b] == pytest.approx(sum(float(hit[b, i]) for i in valid) / max(len(valid), 1))
+
+
+@pytest.mark.parametrize('label_smooth', [0.0, 0.1])
+def test_chunked_loss_matches_full_loss(gpt2_model, label_smooth):
+    model = gpt2_model()
+    tokens = _tokens(2, 10)
+    labels = tokens.roll(-1, dims=1)
+    if label_smooth == 0.0:
+        labels[0, 5] = -1
+    lm_mask = torch.ones(2, 10)
+    lm_mask[:, :3] = 0.0
+
+    losses, grads = [], []
+    for loss_chunk_size in [0, 4]:
+        model.zero_grad()
+        _, loss = model(
+            tokens, lm_labels=labels, lm_mask=lm_mask, label_smooth=label_smooth, loss_chunk_size=loss_chunk_size
+        )
+        loss.backward()
+        losses.append(loss.detach())
+        grads.append([p.grad.clone() for p in model.parameters() if p.requires_grad])
+    assert torch.allclose(losses[0], losses[1], atol=1e-5)
+    for g0, g1 in zip(*grads):
+        assert torch.allclose(g0, g1, atol=1e-5)
+
+
+@pytest.mark.parametrize('checkpoint', [{'checkpoint_every': 1}, {'checkpoint_budget': 1e-3}])
+def test_activation_checkpointing_matches_plain_backward(gpt2_model, checkpoint):
+    tokens = _tokens(2, 10)
+    losses, grads = [], []
+    for model in [gpt2_model(), gpt2_model(**checkpoint)]:
+        # Frozen embeddings, so that the input of the first block does not require grad
+        lora.mark_only_lora_as_trainable(model)
+        model.train()
+        _, loss = model(tokens, lm_labels=tokens.roll(-1, dims=1))
+        loss.backward()
+        losses.append(loss.detach())
+        grads.append([p.grad for p in lora.lora_parameters(model)])
+    assert torch.allclose(losses[0], losses[1], atol=1e-6)
+    assert all(g is not None for g in grads[1])
+    for g0, g1 in zip(*grads):
+        assert torch.allclose(g0, g1, atol=1e-6)
+
+
+@pytest.mark.parametrize('with_lora', [True, False])
+def test_from_pretrained_matches_load_weight(gpt2_model, with_lora):
+    from model import GPT2LMModel
+    model = gpt2_model()
+    config = model.transformer.config
+    # A pretrained checkpoint, or one with the LoRA weights
+    state_dict = {k: v for k, v in model.transformer.state_dict().items() if with_lora or 'lora_' not in k}
+
+    expected = GPT2LMModel(config)
+    expected.load_weight(state_dict)
+    loaded = GPT2LMModel.from_pretrained(config, state_dict)
+    assert not any(t.is_meta for t in list(loaded.parameters()) + list(loaded.buffers()))
+    assert loaded.lm_head.decoder.weight is loaded.transformer.wte.weight
+
+    tokens = _tokens()
+    with torch.no_grad():
+        assert torch.allclose(loaded.eval()(tokens)[0], expected.eval()(tokens)[0], atol=1e-5)
+        if with_lora:
+            assert torch.allclose(loaded(tokens)[0], model(tokens)[0], atol=1e-5)
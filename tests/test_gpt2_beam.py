@@ -0,0 +1,165 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import argparse
+import json
+import os
+
+import pytest
+import torch
+
+import gpt2_beam
+
+SEQ_LEN, EVAL_LEN, EOS = 12, 6, 63
+
+
+def _batches():
+    g = torch.Generator().manual_seed(0)
+    query = torch.randint(0, EOS, (5, SEQ_LEN), generator=g)
+    query_len = torch.tensor([6, 5, 4, 6, 5])
+    # The last batch repeats the first prompts, to start from the prefix cache
+    query[3:] = query[:2]
+    query[torch.arange(SEQ_LEN) >= query_len.unsqueeze(1)] = 0
+    ids = torch.arange(5)
+    return [
+        {'id': ids[:3], 'query': query[:3], 'query_len': query_len[:3]},
+        {'id': ids[3:], 'query': query[3:], 'query_len': query_len[3:]},
+    ]
+
+
+def _decode(model, data_iter, tmp_path, process_group, **kwargs):
+    # Runs beam() or sample() as gpt2_beam.py does, and returns the predictions by id
+    args = argparse.Namespace(
+        device=torch.device('cpu'), rank=0, world_size=1, platform='k8s', dist=process_group,
+        work_dir=str(tmp_path), output_file='predictions.jsonl', decode='beam', beam=3, eval_len=EVAL_LEN,
+        eos_token_id=[EOS], length_penalty=1.0, no_repeat_ngram_size=0, repetition_penalty=1.0, min_length=0,
+        temperature=1.0, top_k=0, top_p=1.0, forced_eos=False, static_kv_cache=False, paged_kv_cache=False,
+        kv_cache_blocks=128, kv_block_size=4
+    )
+    for k, v in kwargs.items():
+        setattr(args, k, v)
+    if args.decode == 'beam':
+        gpt2_beam.beam(model, data_iter, args)
+    else:
+        gpt2_beam.sample(model, data_iter, args)
+    with open(os.path.join(args.work_dir, args.output_file)) as reader:
+        return {p['id']: p['predict'] for p in map(json.loads, reader)}
+
+
+@pytest.mark.parametrize('decode', ['beam', 'greedy'])
+def test_kv_caches_give_the_same_predictions(gpt2_model, process_group, tmp_path, decode):
+    model = gpt2_model()
+    expected = _decode(model, _batches(), tmp_path, process_group, decode=decode)
+
+    assert _decode(model, _batches(), tmp_path, process_group, decode=decode, static_kv_cache=True) == expected
+    # The second time, every prompt starts from its blocks in the prefix cache
+    for _ in range(2):
+        assert _decode(model, _batches(), tmp_path, process_group, decode=decode, paged_kv_cache=True) == expected
+
+
+def test_prefix_cache_is_invalidated_by_weight_updates(gpt2_model, process_group, tmp_path):
+    model = gpt2_model()
+    _decode(model, _batches(), tmp_path, process_group, paged_kv_cache=True)
+    with torch.no_grad():
+        torch.nn.init.normal_(model.transformer.h[0].attn.c_attn.lora_B)
+
+    expected = _decode(model, _batches(), tmp_path, process_group)
+    assert _decode(model, _batches(), tmp_path, process_group, paged_kv_cache=True) == expected
+
+
+def _banned_ngram_tokens(history, n):
+    # The tokens that would repeat an n-gram of each row of history
+    banned = []
+    for row in history.tolist():
+        prefix = row[len(row) - n + 1:]
+        banned.append({row[i + n - 1] for i in range(len(row) - n + 1) if row[i:i + n - 1] == prefix})
+    return banned
+
+
+@pytest.mark.parametrize('n', [2, 3])
+def test_ngram_blocker_matches_naive_ban(n):
+    g = torch.Generator().manual_seed(0)
+    rows, vocab, steps = 6, 5, 12
+    blocker = gpt2_beam.NgramBlocker(n, rows, steps)
+    history = torch.zeros((rows, 0), dtype=torch.long)
+    for i in range(steps):
+        # Every other step reorders the rows like beams, then every row gets a new token
+        beam_idx = torch.randint(0, rows, (rows, ), generator=g) if i % 2 else None
+        if beam_idx is not None:
+            history = history[beam_idx]
+        history = torch.cat([history, torch.randint(0, vocab, (rows, 1), generator=g)], dim=1)
+        blocker.update(beam_idx, history)
+
+        scores = blocker.ban_(torch.zeros(rows, vocab))
+        assert [set(s.isinf().nonzero().view(-1).tolist()) for s in scores] == _banned_ngram_tokens(history, n)
+
+
+def test_repetition_penalty_matches_loop():
+    g = torch.Generator().manual_seed(0)
+    scores = torch.randn(4, 10, generator=g)
+    # Repeated tokens are only penalized once
+    history = torch.randint(0, 10, (4, 6), generator=g)
+    expected = scores.clone()
+    for b in range(4):
+        for t in set(history[b].tolist()):
+            expected[b, t] = expected[b, t] * 1.3 if expected[b, t] < 0 else expected[b, t] / 1.3
+
+    gpt2_beam._enforce_repetition_penalty_(scores, history, 1.3)
+    assert torch.allclose(scores, expected)
+
+
+@pytest.mark.parametrize('length_penalty', [1.0, 0.0, -0.5])
+def test_beam_search_does_not_depend_on_the_batch(gpt2_model, process_group, tmp_path, length_penalty):
+    # Samples finishing early are dropped from the batch, which must not change the others
+    model = gpt2_model()
+    with torch.no_grad():
+        # Makes eos likely after some prompts
+        model.transformer.wte.weight[EOS] *= 30
+    batch = _batches()[0]
+    expected = _decode(model, [batch], tmp_path, process_group, length_penalty=length_penalty)
+
+    predictions = {}
+    for i in range(batch['id'].shape[0]):
+        sample = {k: v[i:i + 1] for k, v in batch.items()}
+        predictions.update(_decode(model, [sample], tmp_path, process_group, length_penalty=length_penalty))
+    assert predictions == expected
+
+
+def test_top_k_and_top_p_processors():
+    g = torch.Generator().manual_seed(0)
+    scores = torch.randn(4, 10, generator=g)
+
+    top_k = gpt2_beam.TopKProcessor(3)(scores.clone(), None, 0)
+    assert [set(s.isfinite().nonzero().view(-1).tolist()) for s in top_k] == \
+        [set(s.topk(3).indices.tolist()) for s in scores]
+
+    top_p = gpt2_beam.TopPProcessor(0.6)(scores.clone(), None, 0)
+    for s, kept in zip(scores, top_p):
+        # The most likely tokens, until their probabilities add up to top_p
+        probs, expected, mass = s.softmax(dim=-1), set(), 0.0
+        for t in s.argsort(descending=True).tolist():
+            if mass > 0.6:
+                break
+            expected.add(t)
+            mass += float(probs[t])
+        assert set(kept.isfinite().nonzero().view(-1).tolist()) == expected
+        assert torch.equal(kept[list(expected)], s[list(expected)])
+
+
+def test_forced_eos_processor():
+    processor = gpt2_beam.ForcedEOSProcessor(EVAL_LEN, [EOS])
+    scores = torch.randn(2, 64)
+    assert torch.equal(processor(scores.clone(), None, EVAL_LEN - 2), scores)
+    forced = processor(scores.clone(), None, EVAL_LEN - 1)
+    assert (forced.argmax(dim=-1) == EOS).all() and forced.isfinite().sum() == 2
+
+
+def test_greedy_decoding_matches_beam_search_of_one_beam(gpt2_model, process_group, tmp_path):
+    model = gpt2_model()
+    with torch.no_grad():
+        model.transformer.wte.weight[EOS] *= 30
+    expected = _decode(model, _batches(), tmp_path, process_group, beam=1)
+    assert _decode(model, _batches(), tmp_path, process_group, decode='greedy') == expected
+    # Sampling from the single most likely token
+    assert _decode(model, _batches(), tmp_path, process_group, decode='sample', top_k=1, temperature=0.7) == expected
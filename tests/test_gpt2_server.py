@@ -0,0 +1,61 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import asyncio
+import copy
+
+import pytest
+import torch
+
+import loralib as lora
+
+# The BPE encoder of the example needs regex
+pytest.importorskip('regex')
+from gpt2_server import GenerationEngine
+
+EOS = 63
+
+
+def _greedy(model, prompt, max_new_tokens):
+    tokens = list(prompt)
+    with torch.no_grad():
+        for _ in range(max_new_tokens):
+            logits, _ = model(torch.tensor([tokens]))
+            tokens.append(int(logits[0, -1].argmax()))
+            if tokens[-1] == EOS:
+                break
+    return tokens[len(prompt):]
+
+
+def test_generation_engine_matches_greedy_decoding(gpt2_model):
+    model = gpt2_model()
+    # Requests without adapter get the pretrained weights only once adapters are registered
+    pretrained = copy.deepcopy(model)
+    for m in pretrained.modules():
+        if isinstance(m, lora.LoRALayer) and hasattr(m, 'lora_B'):
+            torch.nn.init.zeros_(m.lora_B)
+    requests = [([1, 2, 3], 6, 'own'), ([4, 5, 6, 7, 8], 3, None), ([9], 8, 'own'), ([10, 11], 5, None)]
+    expected = [
+        _greedy(model if adapter else pretrained, prompt, max_new_tokens)
+        for prompt, max_new_tokens, adapter in requests
+    ]
+
+    async def main():
+        # Fewer rows than requests, so that requests wait for the rows of finished ones
+        engine = GenerationEngine(model, max_batch_size=2, max_len=32, eos_token_id=(EOS, ))
+        engine.register_adapter('own', lora.lora_state_dict(model))
+        runner = asyncio.ensure_future(engine.run())
+
+        async def collect(prompt, max_new_tokens, adapter):
+            return [token async for token in engine.generate(prompt, max_new_tokens, adapter=adapter)]
+
+        try:
+            for prompt, max_new_tokens, adapter in [([1, 64], 4, None), ([], 4, None), ([1], 0, None), ([1], 4, 'x')]:
+                with pytest.raises(ValueError):
+                    await collect(prompt, max_new_tokens, adapter)
+            return await asyncio.gather(*[collect(*request) for request in requests])
+        finally:
+            runner.cancel()
+
+    assert asyncio.run(main()) == expected
@@ -0,0 +1,22 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import torch
+
+from kv_cache import PagedKVCache
+
+
+def test_paged_kv_cache_evicts_prefix_extensions():
+    cache = PagedKVCache(n_layer=1, num_blocks=4, block_size=2, n_head=1, head_features=2)
+    cache.start(1)
+    query, query_len = torch.tensor([[1, 2, 3, 4, 5]]), torch.tensor([5])
+    cache.advance(5)
+    cache.register_prefix(query, query_len)
+    assert list(cache.prefix_blocks) == [(1, 2), (1, 2, 3, 4)]
+
+    # Taking the blocks of (1, 2) leaves (1, 2, 3, 4) unreachable, so it goes as well
+    cache.start(1)
+    cache.advance(6)
+    assert not cache.prefix_blocks
+    assert cache.match_prefix(query, query_len) == 0
@@ -0,0 +1,188 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import copy
+
+import pytest
+import torch
+
+import loralib as lora
+
+
+def _grads(layer, x, out):
+    # Gradients of a fixed function of the output w.r.t. the input and the LoRA weights
+    layer.zero_grad()
+    x.grad = None
+    (out * torch.arange(out.numel(), dtype=out.dtype).view(out.shape).cos()).sum().backward()
+    return [x.grad, layer.lora_A.grad, layer.lora_B.grad]
+
+
+@pytest.mark.parametrize('fan_in_fan_out', [False, True])
+def test_merged_linear_low_rank_matches_merge_AB(fan_in_fan_out):
+    torch.manual_seed(0)
+    layers = [
+        lora.MergedLinear(
+            8, 12, r=4, lora_alpha=8, enable_lora=[True, False, True], fan_in_fan_out=fan_in_fan_out,
+            low_rank=low_rank
+        ) for low_rank in [True, False]
+    ]
+    torch.nn.init.normal_(layers[0].lora_B)
+    layers[1].load_state_dict(layers[0].state_dict())
+    x = torch.randn(2, 5, 8, requires_grad=True)
+
+    outs = [layer(x) for layer in layers]
+    assert torch.allclose(outs[0], outs[1], atol=1e-4)
+    for g0, g1 in zip(_grads(layers[0], x, outs[0]), _grads(layers[1], x, outs[1])):
+        assert torch.allclose(g0, g1, atol=1e-4)
+
+    # The unmerged forward matches the merged weight
+    layers[0].eval()
+    assert layers[0].merged
+    with torch.no_grad():
+        assert torch.allclose(layers[0](x), outs[0], atol=1e-4)
+
+
+@pytest.mark.parametrize('layer, shape', [
+    (lambda: lora.Linear(8, 6, r=4, lora_alpha=8, merge_weights=False), (3, 8)),
+    (lambda: lora.MergedLinear(8, 12, r=4, lora_alpha=8, enable_lora=[True, False, True], merge_weights=False), (3, 8)),
+    (lambda: lora.Conv2d(4, 6, 3, r=2, lora_alpha=4, merge_weights=False), (2, 4, 5, 5)),
+])
+def test_weight_cache_follows_in_place_updates(layer, shape):
+    torch.manual_seed(0)
+    layer = layer()
+    torch.nn.init.normal_(layer.lora_B)
+    x = torch.randn(*shape)
+    layer.eval()
+    with torch.no_grad():
+        before = layer(x)
+        assert layer._merged_weight is not None
+        layer.lora_B.mul_(2)
+        after = layer(x)
+
+    layer.train()
+    assert layer._merged_weight is None
+    with torch.no_grad():
+        expected = layer(x)
+    assert not torch.allclose(before, after, atol=1e-4)
+    assert torch.allclose(after, expected, atol=1e-4)
+
+
+@pytest.mark.parametrize('layer', [
+    lambda: lora.Linear(8, 6, r=4, lora_alpha=8, fan_in_fan_out=True),
+    lambda: lora.MergedLinear(8, 12, r=4, lora_alpha=8, enable_lora=[True, False, True]),
+    lambda: lora.Conv2d(4, 6, 3, r=2, lora_alpha=4),
+    lambda: lora.Conv2d(4, 6, 3, r=2, lora_alpha=4, low_rank=True, groups=2),
+])
+def test_swap_lora_of_merged_layer(layer):
+    torch.manual_seed(0)
+    layer = layer()
+    torch.nn.init.normal_(layer.lora_B)
+    A, B = torch.randn_like(layer.lora_A), torch.randn_like(layer.lora_B)
+    expected = copy.deepcopy(layer)
+    expected.lora_A.data.copy_(A)
+    expected.lora_B.data.copy_(B)
+    expected.eval()
+
+    layer.eval()
+    layer.swap_lora_(A, B)
+    assert layer.merged
+    assert torch.allclose(layer.weight, expected.weight, atol=1e-5)
+    assert torch.equal(layer.lora_A, A) and torch.equal(layer.lora_B, B)
+
+
+def test_swap_lora_drift():
+    # Swapping back and forth between two adapters in bfloat16 accumulates the rounding
+    # error of the weight, unless it is compensated with track_drift
+    torch.manual_seed(0)
+    base = lora.Linear(64, 64, r=8, lora_alpha=16)
+    adapters = [(torch.randn_like(base.lora_A), torch.randn_like(base.lora_B) * 0.1) for _ in range(2)]
+    A, B = (t.bfloat16().float() for t in adapters[1])
+    expected = base.weight.bfloat16().float() + (B @ A) * base.scaling
+
+    errors = []
+    for track_drift in [False, True]:
+        layer = copy.deepcopy(base).bfloat16()
+        layer.track_drift = track_drift
+        layer.eval()
+        for i in range(50):
+            layer.swap_lora_(*adapters[i % 2])
+        errors.append((layer.weight.float() - expected).abs().max())
+    assert errors[1] < errors[0]
+
+
+@pytest.mark.parametrize('bits', [8, 4])
+@pytest.mark.parametrize('layer', [
+    lambda: lora.Linear(9, 6, r=4, lora_alpha=8, fan_in_fan_out=True),
+    lambda: lora.MergedLinear(9, 12, r=4, lora_alpha=8, enable_lora=[True, False, True]),
+])
+def test_quantized_weight(layer, bits):
+    torch.manual_seed(0)
+    layer = layer()
+    torch.nn.init.normal_(layer.lora_B)
+    w = layer.base_weight().detach().clone()
+    layer.quantize_weight(bits)
+
+    # Within half a quantization step of the weight, an odd in_features being padded for 4 bits
+    w_q = layer.base_weight()
+    assert w_q.shape == w.shape
+    assert ((w_q - w).abs() <= layer.weight_scale.unsqueeze(1) / 2 + 1e-6).all()
+
+    # The same outputs and gradients as the unquantized layer with the dequantized weight
+    ref = copy.deepcopy(layer)
+    ref.dequantize_weight()
+    x = torch.randn(3, 9, requires_grad=True)
+    out, ref_out = layer(x), ref(x)
+    assert torch.allclose(out, ref_out, atol=1e-5)
+    for g, ref_g in zip(_grads(layer, x, out), _grads(ref, x, ref_out)):
+        assert torch.allclose(g, ref_g, atol=1e-5)
+
+    # Dequantizing restores merging
+    ref.eval()
+    assert ref.merged
+    with torch.no_grad():
+        assert torch.allclose(ref(x), ref_out, atol=1e-5)
+
+
+def test_quantize_embedding_is_not_supported():
+    with pytest.raises(NotImplementedError):
+        lora.Embedding(10, 4, r=2).quantize_weight()
+
+
+def test_sparse_embedding_lora_grad():
+    torch.manual_seed(0)
+    layers = [lora.Embedding(10, 4, r=2, padding_idx=0, sparse=sparse) for sparse in [False, True]]
+    torch.nn.init.normal_(layers[0].lora_A)
+    layers[1].load_state_dict(layers[0].state_dict())
+    x = torch.tensor([[0, 3, 3], [5, 0, 7]])
+
+    outs = [layer(x) for layer in layers]
+    assert torch.allclose(outs[0], outs[1], atol=1e-6)
+    for layer, out in zip(layers, outs):
+        (out * torch.arange(out.numel(), dtype=out.dtype).view(out.shape).cos()).sum().backward()
+    grad, sparse_grad = layers[0].lora_A.grad, layers[1].lora_A.grad
+    assert sparse_grad.is_sparse
+    assert torch.allclose(sparse_grad.to_dense(), grad, atol=1e-6)
+    # Only the looked up tokens other than padding_idx get a gradient
+    assert (grad[:, [0, 1, 2, 4, 6, 8, 9]] == 0).all()
+
+
+@pytest.mark.parametrize('low_rank', [True, False])
+@pytest.mark.parametrize('layer, shape', [
+    (lambda **kw: lora.Conv1d(4, 6, 3, r=2, lora_alpha=4, padding=1, **kw), (2, 4, 9)),
+    (lambda **kw: lora.Conv2d(4, 6, (3, 5), r=2, lora_alpha=4, padding=(1, 2), stride=2, groups=2, **kw), (2, 4, 7, 9)),
+    (lambda **kw: lora.Conv3d(2, 4, 3, r=2, lora_alpha=4, **kw), (1, 2, 4, 5, 5)),
+])
+def test_conv_lora_matches_merged_weight(layer, shape, low_rank):
+    torch.manual_seed(0)
+    layer = layer(low_rank=low_rank)
+    torch.nn.init.normal_(layer.lora_B)
+    x = torch.randn(*shape)
+    out = layer(x)
+    out.sum().backward()
+    assert layer.lora_A.grad is not None and layer.lora_B.grad is not None
+
+    layer.eval()
+    assert layer.merged
+    with torch.no_grad():
+        assert torch.allclose(layer(x), out, atol=1e-4)
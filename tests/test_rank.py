@@ -0,0 +1,65 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import pytest
+import torch
+
+import loralib as lora
+
+
+def _set_update_rank(layer, rank):
+    # Random lora_A and lora_B of rank r whose update only has the given rank in every group
+    g = layer._lora_groups()
+    B = torch.randn(g, layer.lora_B.shape[0] // g, rank) @ torch.randn(g, rank, layer.r)
+    layer.lora_B.data.copy_(B.flatten(0, 1))
+    torch.nn.init.normal_(layer.lora_A)
+
+
+def _model():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(
+        lora.Linear(10, 12, r=8, lora_alpha=16),
+        torch.nn.ReLU(),
+        lora.MergedLinear(12, 18, r=8, lora_alpha=16, enable_lora=[True, False, True]),
+    )
+    _set_update_rank(model[0], 2)
+    _set_update_rank(model[2], 3)
+    return model
+
+
+@pytest.mark.parametrize('layer', [0, 2])
+def test_truncate_lora_rank_keeps_low_rank_update(layer):
+    layer = _model()[layer]
+    x = torch.randn(4, layer.in_features)
+    expected = layer(x)
+
+    truncate_to = 2 if isinstance(layer, lora.Linear) else 3
+    lora.truncate_lora_rank(layer, truncate_to)
+    assert layer.r == truncate_to and layer.scaling == layer.lora_alpha / truncate_to
+    assert layer.lora_A.shape[0] == truncate_to * layer._lora_groups()
+    assert torch.allclose(layer(x), expected, atol=1e-3)
+
+
+def test_prune_lora_rank_by_energy():
+    model = _model()
+    x = torch.randn(4, 10)
+    expected = model(x)
+
+    assert lora.prune_lora_rank(model, energy=0.99999) == {'0': 2, '2': 3}
+    assert torch.allclose(model(x), expected, atol=1e-3)
+
+    # A model of the same ranks loads the pruned LoRA weights
+    state_dict = lora.lora_state_dict(model)
+    pruned = _model()
+    lora.set_lora_ranks(pruned, lora.lora_rank_map(state_dict))
+    pruned.load_state_dict(state_dict, strict=False)
+    assert torch.allclose(pruned(x), expected, atol=1e-3)
+
+
+def test_prune_lora_rank_by_param_budget():
+    model = _model()
+    # Each rank costs 10 + 12 parameters in the first layer, and 2 * (12 + 6) in the second
+    ranks = lora.prune_lora_rank(model, param_budget=2 * 22 + 3 * 36)
+    assert ranks == {'0': 2, '2': 3}
+    assert sum(p.numel() for p in lora.lora_parameters(model)) == 2 * 22 + 3 * 36
@@ -0,0 +1,66 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import pytest
+import torch
+import torch.nn as nn
+
+import loralib as lora
+
+
+class _Net(nn.Module):
+    def __init__(self):
+        super(_Net, self).__init__()
+        self.emb = nn.Embedding(10, 8)
+        self.fc = nn.Linear(8, 12)
+        self.conv = nn.Conv1d(12, 6, 3, padding=1)
+
+    def forward(self, x):
+        return self.conv(self.fc(self.emb(x)).transpose(1, 2))
+
+
+def _inject(model):
+    weights = {n: p for n, p in model.named_parameters()}
+    assert lora.inject_lora(model, ['emb', 'f*', 'conv'], r=2, lora_alpha=4) == ['emb', 'fc', 'conv']
+    # The LoRA layers share the parameters of the modules they replace
+    assert all(dict(model.named_parameters())[n] is p for n, p in weights.items())
+    assert isinstance(model.emb, lora.Embedding) and isinstance(model.conv, lora.Conv1d)
+    for p in lora.lora_parameters(model):
+        torch.nn.init.normal_(p)
+
+
+@pytest.mark.parametrize('train', [True, False])
+@pytest.mark.parametrize('merge', [True, False])
+def test_inject_and_eject_lora(train, merge):
+    torch.manual_seed(0)
+    model = _Net().train(train)
+    x = torch.tensor([[1, 2, 3, 4], [5, 6, 7, 8]])
+    with torch.no_grad():
+        expected = model(x)
+        weights = {n: p.clone() for n, p in model.named_parameters()}
+
+    lora.inject_lora(model, ['emb', 'fc', 'conv'], r=2)
+    with torch.no_grad():
+        # lora_B is zero, or lora_A for the embedding, so the outputs do not change
+        assert torch.allclose(model(x), expected, atol=1e-5)
+    lora.eject_lora(model)
+
+    # LoRA weights are set in train mode, then eval mode merges them into the shared weights
+    model.train()
+    _inject(model)
+    model.train(train)
+    with torch.no_grad():
+        adapted = model(x)
+    assert not torch.allclose(adapted, expected, atol=1e-3)
+
+    assert lora.eject_lora(model, merge=merge) == ['emb', 'fc', 'conv']
+    assert type(model.emb) is nn.Embedding and type(model.fc) is nn.Linear and type(model.conv) is nn.Conv1d
+    assert model.training == train
+    assert not lora.lora_state_dict(model)
+    with torch.no_grad():
+        if merge:
+            assert torch.allclose(model(x), adapted, atol=1e-4)
+        else:
+            assert torch.allclose(model(x), expected, atol=1e-5)
+            assert all(torch.allclose(p, weights[n], atol=1e-5) for n, p in model.named_parameters())
@@ -0,0 +1,55 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import json
+
+import torch
+
+import loralib as lora
+
+
+def _model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(
+        lora.Linear(8, 16, r=4),
+        torch.nn.ReLU(),
+        lora.Linear(16, 4, r=2),
+    )
+
+
+def test_sharded_lora_state_dict_round_trip(tmp_path):
+    model = _model()
+    # lora_A and lora_B of the first layer take 128 and 256 bytes, those of the second 128 and 32 bytes
+    lora.save_lora_state_dict(model, str(tmp_path), max_shard_size=200)
+    with open(tmp_path / lora.LORA_INDEX_NAME) as reader:
+        index = json.load(reader)
+    assert len(set(index['weight_map'].values())) == 3
+    assert index['metadata']['total_size'] == 544
+
+    state_dict = lora.load_lora_state_dict(str(tmp_path))
+    expected = lora.lora_state_dict(model)
+    assert state_dict.keys() == expected.keys()
+    assert all(torch.equal(state_dict[k], expected[k]) for k in expected)
+
+
+def test_lora_index_follows_module_replacement():
+    model = _model()
+    assert set(lora.lora_state_dict(model)) == {'0.lora_A', '0.lora_B', '2.lora_A', '2.lora_B'}
+
+    # A module replaced after the index was built
+    model[1] = lora.Linear(16, 16, r=2)
+    lora.mark_only_lora_as_trainable(model, bias='lora_only')
+    assert set(lora.lora_state_dict(model)) == {
+        '0.lora_A', '0.lora_B', '1.lora_A', '1.lora_B', '2.lora_A', '2.lora_B'
+    }
+    assert {n for n, p in model.named_parameters() if p.requires_grad} == {
+        '0.lora_A', '0.lora_B', '0.bias', '1.lora_A', '1.lora_B', '1.bias', '2.lora_A', '2.lora_B', '2.bias'
+    }
+
+
+def test_lora_state_dict_include_exclude():
+    model = _model()
+    assert set(lora.lora_state_dict(model, include=['0'])) == {'0.lora_A', '0.lora_B'}
+    assert set(lora.lora_state_dict(model, exclude=['0'])) == {'2.lora_A', '2.lora_B'}
+    assert set(lora.lora_state_dict(model, bias='all', exclude=['0'])) == {'0.bias', '2.lora_A', '2.lora_B', '2.bias'}